@@ -1,17 +1,25 @@
+import base64
+import functools
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
 
 import settings
-from cryptography.fernet import Fernet
-import base64
+from cryptography.fernet import Fernet, MultiFernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 
-def generate_key():
-    password_provided = settings.SECRET_KEY
+def generate_key(password_provided=None, salt=None):
+    if password_provided is None:
+        password_provided = settings.SECRET_KEY
+    if salt is None:
+        salt = settings.SALT
     password = password_provided.encode()
-    salt = settings.SALT
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
@@ -23,11 +31,17 @@ def generate_key():
     return key
 
 
+@functools.lru_cache(maxsize=None)
+def get_fernet():
+    # PBKDF2 is deliberately slow, derive the keys once per process. The first key encrypts,
+    # the previous ones are only tried on decryption so rows written before a rotation still work.
+    keys = [settings.SECRET_KEY] + settings.PREVIOUS_KEYS
+    return MultiFernet([Fernet(generate_key(key)) for key in keys])
+
+
 def encrypt(message):
-    key = generate_key()
     message = message.encode()
-    f = Fernet(key)
-    encrypted_message = f.encrypt(message)
+    encrypted_message = get_fernet().encrypt(message)
     return encrypted_message.decode()
 
 
@@ -36,9 +50,97 @@ def compare(raw, encrypted):
 
 
 def decrypt(encrypted_message):
-    key = generate_key()
     encrypted_message = encrypted_message.encode()
-    f = Fernet(key)
-    message = f.decrypt(encrypted_message)
+    message = get_fernet().decrypt(encrypted_message)
     return message.decode()
 
+
+def rotate(encrypted_message):
+    encrypted_message = encrypted_message.encode()
+    rotated_message = get_fernet().rotate(encrypted_message)
+    return rotated_message.decode()
+
+
+class PoolBusyError(Exception):
+    pass
+
+
+def watch_parent(parent_pid):
+    # a server killed with SIGKILL never shuts its pool down, the workers leave on their own once orphaned
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, name="parent-watch", daemon=True).start()
+
+
+class WorkerPool(object):
+    def __init__(self, workers=settings.CRYPTO_WORKERS, queue_size=settings.CRYPTO_QUEUE_SIZE,
+                 timeout=settings.CRYPTO_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max(workers, 1) + queue_size)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawned, not forked: workers must not inherit the listening socket or client sockets, or a
+                # closed client never sees EOF and orphaned workers keep the port bound after the server dies
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=watch_parent, initargs=(os.getpid(),))
+            return self.executor
+
+    def replace_executor(self, broken):
+        with self.lock:
+            if self.executor is broken:
+                self.executor = None
+        # a broken executor has already terminated its workers, shutting it down again races its management
+        # thread on Python 3.8
+
+    def start(self):
+        """Start the worker processes up front, so the first logins do not wait for them to boot."""
+        if self.workers <= 0:
+            return
+        executor = self.get_executor()
+        wait([executor.submit(int) for _ in range(self.workers)])
+
+    def call(self, executor, fn, *args):
+        # fail fast instead of queueing without bound, the client gets an ERROR and may retry
+        if not self.slots.acquire(blocking=False):
+            raise PoolBusyError("Server is busy. Try again later.")
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PoolBusyError("Server is busy. Try again later.")
+
+    def run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        # a worker that died (killed, out of memory) breaks the executor for every later call,
+        # it is replaced and the call retried once before the client gets an ERROR
+        for _ in range(2):
+            executor = self.get_executor()
+            try:
+                return self.call(executor, fn, *args)
+            except BrokenProcessPool:
+                self.replace_executor(executor)
+        raise PoolBusyError("Server is busy. Try again later.")
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+pool = WorkerPool()
@@ -0,0 +1,91 @@
+import collections
+import threading
+
+import settings
+from backend import metrics
+from core import messages
+
+
+def coalesce(previous, event):
+    # a post the subscriber has not been told about yet stays a "create", and vanishes if it is deleted again
+    if previous["op"] == "create":
+        if event["op"] == "delete":
+            return None
+        return dict(event, op="create")
+    return event
+
+
+class Subscription(object):
+    """Notifications waiting for one connection, at most one per post and never more than max_pending."""
+
+    def __init__(self, db_name, on_ready, max_pending=settings.SUBSCRIPTION_QUEUE_SIZE):
+        self.db_name = db_name
+        self.on_ready = on_ready
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.overflowed = False
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+    def push(self, event):
+        with self.lock:
+            previous = self.pending.pop(event["id"], None)
+            if previous is not None:
+                metrics.notifications_total.inc("coalesced")
+                event = coalesce(previous, event)
+            if event is not None:
+                self.pending[event["id"]] = event
+            if len(self.pending) > self.max_pending:
+                # the subscriber fell too far behind, it is told to reload the posts instead
+                metrics.notifications_total.inc("overflow")
+                self.pending.clear()
+                self.overflowed = True
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.on_ready(self)
+
+    def drain(self):
+        # returns None once nothing is left, the next push wakes the pusher again
+        with self.lock:
+            if self.overflowed:
+                self.overflowed = False
+                return messages.Notification("resync")
+            if self.pending:
+                events = list(self.pending.values())
+                self.pending.clear()
+                return messages.Notification("posts", events)
+            self.scheduled = False
+            return None
+
+
+class Hub(object):
+    """Fans post changes out to subscribed connections, publishing never waits for a subscriber."""
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, db_name, on_ready):
+        subscription = Subscription(db_name, on_ready)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        metrics.subscribers.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription not in self.subscriptions:
+                return
+            self.subscriptions.discard(subscription)
+        metrics.subscribers.dec()
+
+    def publish(self, db_name, event):
+        with self.lock:
+            subscriptions = [subscription for subscription in self.subscriptions if subscription.db_name == db_name]
+        for subscription in subscriptions:
+            subscription.push(event)
+        metrics.notifications_total.inc("published")
+
+
+hub = Hub()
@@ -0,0 +1,44 @@
+import sqlite3
+import threading
+
+import settings
+import utils
+from core import models
+from utils import logger
+
+
+class MaintenanceThread(threading.Thread):
+    def __init__(self, db_name=settings.DATABASE, interval=settings.MAINTENANCE_INTERVAL,
+                 batch_size=settings.MAINTENANCE_BATCH_SIZE):
+        super().__init__(daemon=True)
+        self.db_name = db_name
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def sweep(self) -> int:
+        token_model = models.AuthToken(self.db_name)
+        reclaimed = 0
+        # short batches keep the write lock free for request threads in between
+        while True:
+            deleted = token_model.delete_expired(self.batch_size)
+            reclaimed += deleted
+            if deleted < self.batch_size:
+                break
+        token_model.conn.execute("PRAGMA optimize")
+        token_model.conn.execute("PRAGMA incremental_vacuum").fetchall()
+        return reclaimed
+
+    def run(self) -> None:
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    reclaimed = self.sweep()
+                    logger.info(f"Maintenance: removed {reclaimed} expired auth tokens")
+                except sqlite3.Error as e:
+                    logger.info(f"Maintenance failed: {e}")
+        finally:
+            utils.connections.release()
+
+    def stop(self) -> None:
+        self.stopped.set()
@@ -0,0 +1,190 @@
+import abc
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+import utils
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def format_labels(self, labels, **extra):
+        pairs = list(zip(self.labelnames, labels)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    @abc.abstractmethod
+    def samples(self):
+        pass
+
+    @abc.abstractmethod
+    def snapshot(self):
+        pass
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value:g}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(self.name, self.format_labels(labels), value) for labels, value in values]
+
+    def snapshot(self):
+        with self.lock:
+            return {"/".join(labels) or "total": value for labels, value in sorted(self.values.items())}
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # per bucket counts are kept non-cumulative, rendering adds them up
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, ([*counts], count, total)) for labels, (counts, count, total) in self.values.items())
+        samples = []
+        for labels, (counts, count, total) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (None,), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound is None else f"{bound:g}"
+                samples.append((f"{self.name}_bucket", self.format_labels(labels, le=le), cumulative))
+            samples.append((f"{self.name}_count", self.format_labels(labels), count))
+            samples.append((f"{self.name}_sum", self.format_labels(labels), total))
+        return samples
+
+    def quantile(self, counts, count, q):
+        # upper bound of the bucket holding the q-th observation, None when it is above the last bucket
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            values = sorted((labels, ([*counts], count, total)) for labels, (counts, count, total) in self.values.items())
+        return {
+            "/".join(labels) or "total": {
+                "count": count,
+                "sum": total,
+                "p50": self.quantile(counts, count, 0.5),
+                "p95": self.quantile(counts, count, 0.95),
+                "p99": self.quantile(counts, count, 0.99),
+            }
+            for labels, (counts, count, total) in values
+        }
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+registry = Registry()
+requests_total = registry.register(Counter(
+    "proton_requests_total", "Handled requests by action and response status.", ("action", "status")))
+request_duration = registry.register(Histogram(
+    "proton_request_duration_seconds", "Time spent building a response by action.", ("action",)))
+send_duration = registry.register(Histogram(
+    "proton_send_duration_seconds", "Time spent serializing and writing a response by action.", ("action",)))
+request_bytes = registry.register(Histogram(
+    "proton_request_bytes", "Size of received requests by action.", ("action",), SIZE_BUCKETS))
+response_bytes = registry.register(Histogram(
+    "proton_response_bytes", "Size of sent responses by action.", ("action",), SIZE_BUCKETS))
+db_query_duration = registry.register(Histogram(
+    "proton_db_query_duration_seconds", "Time spent executing SQL statements."))
+db_connections_total = registry.register(Counter(
+    "proton_db_connections_total", "Pooled SQLite connection lookups by result.", ("result",)))
+active_connections = registry.register(Gauge(
+    "proton_active_connections", "Currently open client connections."))
+handshake_duration = registry.register(Histogram(
+    "proton_tls_handshake_duration_seconds", "Duration of completed TLS handshakes."))
+handshakes_total = registry.register(Counter(
+    "proton_tls_handshakes_total", "TLS handshakes by result.", ("result",)))
+subscribers = registry.register(Gauge(
+    "proton_subscribers", "Connections subscribed to post notifications."))
+notifications_total = registry.register(Counter(
+    "proton_notifications_total", "Published post changes and how subscriber queues handled them.", ("result",)))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(address=(settings.METRICS_HOST, settings.METRICS_PORT)):
+    http_server = ThreadingHTTPServer(address, MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="proton-metrics", daemon=True).start()
+    utils.logger.info(f"Serving metrics at http://{address[0]}:{http_server.server_port}/metrics")
+    return http_server
@@ -1,40 +1,92 @@
+import asyncio
 import os
 import socket
 import ssl
 import threading
-from time import sleep
+import time
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Union
 
 import settings
-from core import messages, controllers, models
-from utils import Logger
+import utils
+from backend import crypto, metrics
+from backend.hub import hub
+from backend.maintenance import MaintenanceThread
+from core import messages, controllers
+from utils import logger
 
-logger = Logger()
 
+class FrameTooLargeError(utils.ProtonError):
+    pass
 
-def recv_all(sock: ssl.SSLSocket) -> str:
-    try:
-        result = ""
-        while result[-2:] != "\r\n":
-            result += sock.read(1).decode()
-    except ssl.SSLWantReadError as e:
-        print(e)
-    finally:
-        return result
 
+class FrameReader(object):
+    delimiter = b"\r\n"
+    chunk_size = 2 ** 16
 
-def send(sock: ssl.SSLSocket, response: messages.Response) -> None:
-    lock = threading.Lock()
-    lock.acquire()
+    def __init__(self, max_frame_size=settings.MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.scanned = 0
 
-    message_str = response.json_response
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
 
-    if isinstance(message_str, str):
-        message_str = message_str.encode()
-    sock.write(message_str)
+    def next_frame(self) -> Optional[bytes]:
+        # start where the previous scan stopped, minus one byte in case "\r" ended the last chunk
+        index = self.buffer.find(self.delimiter, max(self.scanned - 1, 0))
+        if index == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.max_frame_size:
+                raise FrameTooLargeError(f"Message exceeds {self.max_frame_size} bytes.")
+            return None
+        if index > self.max_frame_size:
+            raise FrameTooLargeError(f"Message exceeds {self.max_frame_size} bytes.")
+        frame = bytes(self.buffer[:index])
+        del self.buffer[:index + len(self.delimiter)]
+        self.scanned = 0
+        return frame
+
+
+def recv_frame(sock: ssl.SSLSocket, frames: FrameReader) -> Optional[bytes]:
+    frame = frames.next_frame()
+    while frame is None:
+        data = sock.recv(frames.chunk_size)
+        if not data:
+            return None
+        frames.feed(data)
+        frame = frames.next_frame()
+    return frame
+
+
+def send(sock: ssl.SSLSocket, response: messages.Response, lock: Optional[threading.Lock] = None) -> None:
+    with lock or threading.Lock():
+        start = time.perf_counter()
+        size = 0
+        # large responses are written as they are serialized instead of being built in memory first
+        for chunk in response.iter_chunks():
+            sock.sendall(chunk)
+            size += len(chunk)
+        observe_response(response, size, time.perf_counter() - start)
     host, port = sock.getpeername()
-    lock.release()
 
-    host = f"{host}:{port}"
+    log_response(response, f"{host}:{port}")
+
+
+def observe_response(response: messages.Response, size: int, duration: float) -> None:
+    # responses carry the action upper-cased, labels follow the request side
+    action = response.action.lower() or "unknown"
+    metrics.response_bytes.observe(size, action)
+    metrics.send_duration.observe(duration, action)
+
+
+def describe_tls(ssl_object: Union[ssl.SSLSocket, ssl.SSLObject]) -> str:
+    resumed = ", resumed" if ssl_object.session_reused else ""
+    return f"{ssl_object.version()}{resumed}"
+
+
+def log_response(response: messages.Response, host: str) -> None:
     message = response.message if response.message is not None else ""
     log_args = (response.action, message, host)
 
@@ -46,77 +98,531 @@ def send(sock: ssl.SSLSocket, response: messages.Response) -> None:
         logger.error(*log_args)
 
 
-class ClientThread(threading.Thread):
-    def __init__(self, secure_socket: ssl.SSLSocket):
-        super().__init__()
-        self.secure_socket = secure_socket
+# shared by all threaded connections, so pooled sqlite connections stay bounded by its size
+pipeline_executor = ThreadPoolExecutor(max_workers=settings.PIPELINE_WORKERS, thread_name_prefix="pipeline")
+# free workers of pipeline_executor, requests are only queued on it when one is idle
+pipeline_slots = threading.BoundedSemaphore(settings.PIPELINE_WORKERS)
+
+
+class Client(object):
+    # read-only actions that may run concurrently when the client tags its requests with an id
+    concurrent_actions = ("get", "media")
+
+    def __init__(self, db_name=settings.DATABASE, media_root=settings.MEDIA_ROOT):
+        self.db_name = db_name
+        self.media_root = media_root
         self.auth_token = None
+        self.subscription = None
+
+    def get_response(self, request) -> messages.Response:
+        controller = controllers.Controller(self.auth_token, self.db_name, self.media_root)
+        response = controller.dispatch(request)
+        if request.action in ("login", "logout") and response.status == "OK":
+            self.auth_token = controller.auth_token
+        if request.action == "subscribe" and response.status == "OK":
+            self.subscribe()
+        elif request.action in ("unsubscribe", "logout"):
+            self.unsubscribe()
+        return response
+
+    def subscribe(self) -> None:
+        if self.subscription is None:
+            self.subscription = hub.subscribe(self.db_name, self.wake_pusher)
+
+    def unsubscribe(self) -> None:
+        if self.subscription is not None:
+            hub.unsubscribe(self.subscription)
+            self.subscription = None
 
-    def get_request(self):
-        raw_message = recv_all(self.secure_socket)
+    def wake_pusher(self, subscription) -> None:
+        # called by the publishing thread, it must only hand the work over and never write itself
+        pass
+
+    def parse(self, raw_message: Union[str, bytes]) -> messages.Request:
+        # the codec reads bytes directly, invalid UTF-8 is rejected as a syntax error by the request
         request = messages.Request(raw_message)
+        metrics.request_bytes.observe(len(raw_message), request.action)
         return request
 
-    def get_response(self, request) -> messages.Response:
-        controller = controllers.Controller(self.auth_token)
-        response = getattr(controller, request.action)(request)
-        if request.action == "login" and response.status == "OK":
-            token_id = response.data[0]["id"]
-            token = models.AuthToken().first(id=token_id)[2]
-            self.auth_token = token
-        elif request.action == "logout" and response.status == "OK":
-            self.auth_token = None
+    def get_error_response(self, error: Exception) -> messages.Response:
+        response = messages.Response(status="ERROR", message=str(error))
+        request_id = getattr(error, "request_id", None)
+        if request_id is not None:
+            response.set_request_id(request_id)
+        return response
+
+    def handle_request(self, request: messages.Request) -> messages.Response:
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        except (PermissionError, utils.ProtonError) as e:
+            response = messages.Response(status="ERROR", message=str(e), action=request.action)
+        metrics.request_duration.observe(time.perf_counter() - start, request.action)
+        metrics.requests_total.inc(request.action, response.status)
+        if request.id is not None:
+            response.set_request_id(request.id)
         return response
 
+    def handle(self, raw_message: Union[str, bytes]) -> messages.Response:
+        try:
+            request = self.parse(raw_message)
+        except utils.ProtonError as e:
+            return self.get_error_response(e)
+        return self.handle_request(request)
+
+    def is_concurrent(self, request: messages.Request) -> bool:
+        # requests without an id are answered strictly in order
+        return request.id is not None and request.action in self.concurrent_actions
+
+
+class ClientThread(Client, threading.Thread):
+    def __init__(self, secure_socket: ssl.SSLSocket, db_name=settings.DATABASE,
+                 on_close: Optional[Callable[[], None]] = None, media_root=settings.MEDIA_ROOT):
+        Client.__init__(self, db_name, media_root)
+        threading.Thread.__init__(self, daemon=True)
+        self.secure_socket = secure_socket
+        self.on_close = on_close
+        self.write_lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(settings.PIPELINE_DEPTH)
+        self.pending = set()
+        self.pusher = None
+        self.push_ready = threading.Event()
+        self.closed = False
+
+    def send(self, response: messages.Response) -> None:
+        send(self.secure_socket, response, self.write_lock)
+
+    def subscribe(self) -> None:
+        super().subscribe()
+        if self.pusher is None:
+            # a slow subscriber only ever blocks its own pusher, never the publisher or other connections
+            self.pusher = threading.Thread(target=self.run_pusher, name="pusher", daemon=True)
+            self.pusher.start()
+
+    def wake_pusher(self, subscription) -> None:
+        self.push_ready.set()
+
+    def run_pusher(self) -> None:
+        try:
+            while True:
+                self.push_ready.wait()
+                self.push_ready.clear()
+                if self.closed:
+                    return
+                subscription = self.subscription
+                notification = subscription.drain() if subscription is not None else None
+                while notification is not None:
+                    self.send(notification)
+                    notification = subscription.drain()
+        except OSError:
+            # a write that timed out leaves the subscription scheduled and never woken again, the subscriber
+            # is dropped together with its connection instead of silently missing every later change
+            self.unsubscribe()
+            try:
+                self.secure_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def process(self, request: messages.Request) -> None:
+        self.send(self.handle_request(request))
+
+    def submit(self, request: messages.Request) -> bool:
+        self.in_flight.acquire()
+        if not pipeline_slots.acquire(blocking=False):
+            self.in_flight.release()
+            return False
+        future = pipeline_executor.submit(self.process, request)
+        self.pending.add(future)
+        future.add_done_callback(self.finish)
+        return True
+
+    def finish(self, future: Future) -> None:
+        self.pending.discard(future)
+        self.in_flight.release()
+        pipeline_slots.release()
+
+    def wait_pending(self) -> None:
+        futures.wait(list(self.pending))
+
     def run(self) -> None:
+        frames = FrameReader()
+        try:
+            while True:
+                raw_message = recv_frame(self.secure_socket, frames)
+                if raw_message is None:
+                    break
+                try:
+                    request = self.parse(raw_message)
+                except utils.ProtonError as e:
+                    self.wait_pending()
+                    self.send(self.get_error_response(e))
+                    continue
+                if self.is_concurrent(request):
+                    # workers block in sendall while their reader is slow, once all of them are taken
+                    # the request is answered on this connection's own thread instead of waiting for one
+                    if not self.submit(request):
+                        self.process(request)
+                else:
+                    # anything that may change state waits until the reads sent before it are answered
+                    self.wait_pending()
+                    self.process(request)
+        except FrameTooLargeError as e:
+            self.wait_pending()
+            self.send(messages.Response(status="ERROR", message=str(e)))
+        except socket.timeout:
+            logger.info("Closing idle connection")
+        except OSError:
+            pass
+        finally:
+            self.wait_pending()
+            self.unsubscribe()
+            self.closed = True
+            self.push_ready.set()
+            self.secure_socket.close()
+            utils.connections.release()
+            if self.on_close is not None:
+                self.on_close()
+
+
+def take_chunks(chunks: Iterator[bytes], size: int) -> List[bytes]:
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        size -= len(chunk)
+        if size <= 0:
+            break
+    return batch
+
+
+class AsyncClient(Client):
+    stream_batch_size = 2 ** 18
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, db_name=settings.DATABASE,
+                 media_root=settings.MEDIA_ROOT):
+        super().__init__(db_name, media_root)
+        self.reader = reader
+        self.writer = writer
+        # the transport forgets its peer once the connection is lost, responses may still be logged after that
+        self.peername = writer.get_extra_info("peername")[:2]
+        # responses and notifications are written by tasks on the loop, one at a time
+        self.write_lock = asyncio.Lock()
+        self.in_flight = asyncio.Semaphore(settings.PIPELINE_DEPTH)
+        self.pending = set()
+        self.loop = None
+        self.pusher = None
+        self.push_ready = asyncio.Event()
+
+    async def write(self, chunk: bytes) -> None:
+        self.writer.write(chunk)
+        try:
+            await asyncio.wait_for(self.writer.drain(), settings.WRITE_TIMEOUT or None)
+        except asyncio.TimeoutError:
+            # the peer stopped reading, dropping it frees whoever waits here and ends the reading loop
+            self.writer.transport.abort()
+            raise
+
+    async def iter_chunks(self, response: messages.Response) -> AsyncIterator[bytes]:
+        if not response.streamed:
+            for chunk in response.iter_chunks():
+                yield chunk
+            return
+        # building streamed chunks reads sqlite or the media file, it runs in the executor a batch at a time,
+        # while only the loop waits for the peer to read them: a slow reader never holds an executor thread
+        chunks = iter(response.iter_chunks())
         while True:
-            try:
-                request = self.get_request()
-                response = self.get_response(request)
-                send(self.secure_socket, response)
-            except PermissionError as e:
-                response = messages.Response(status="ERROR", message=str(e))
-                send(self.secure_socket, response)
+            batch = await self.loop.run_in_executor(None, take_chunks, chunks, self.stream_batch_size)
+            if not batch:
+                return
+            for chunk in batch:
+                yield chunk
+
+    async def send(self, response: messages.Response) -> None:
+        async with self.write_lock:
+            start = time.perf_counter()
+            size = 0
+            async for chunk in self.iter_chunks(response):
+                await self.write(chunk)
+                size += len(chunk)
+            observe_response(response, size, time.perf_counter() - start)
+        self.log(response)
+
+    def log(self, response: messages.Response) -> None:
+        host, port = self.peername
+        log_response(response, f"{host}:{port}")
+
+    async def process(self, request: messages.Request) -> None:
+        # controllers talk to sqlite synchronously, keep them off the event loop
+        response = await self.loop.run_in_executor(None, self.handle_request, request)
+        await self.send(response)
+
+    def subscribe(self) -> None:
+        super().subscribe()
+        self.loop.call_soon_threadsafe(self.start_pusher)
+
+    def start_pusher(self) -> None:
+        if self.pusher is None:
+            self.pusher = self.loop.create_task(self.run_pusher())
+
+    def wake_pusher(self, subscription) -> None:
+        self.loop.call_soon_threadsafe(self.push_ready.set)
+
+    async def run_pusher(self) -> None:
+        try:
+            while True:
+                await self.push_ready.wait()
+                self.push_ready.clear()
+                subscription = self.subscription
+                notification = subscription.drain() if subscription is not None else None
+                while notification is not None:
+                    # written from this task, a subscriber that stops reading never holds an executor thread
+                    await self.send(notification)
+                    notification = subscription.drain()
+        except (OSError, asyncio.TimeoutError):
+            # write() has dropped the connection already, the subscription goes with it
+            self.unsubscribe()
+
+    def finish(self, future: asyncio.Future) -> None:
+        self.pending.discard(future)
+        self.in_flight.release()
+        if not future.cancelled():
+            # failures of pipelined requests mean the connection is gone, the reading loop notices it too
+            future.exception()
+
+    async def wait_pending(self) -> None:
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+
+    async def recv_frame(self, frames: FrameReader) -> Optional[bytes]:
+        frame = frames.next_frame()
+        while frame is None:
+            data = await asyncio.wait_for(self.reader.read(frames.chunk_size), settings.IDLE_TIMEOUT or None)
+            if not data:
+                return None
+            frames.feed(data)
+            frame = frames.next_frame()
+        return frame
+
+    async def run(self) -> None:
+        loop = self.loop = asyncio.get_running_loop()
+        frames = FrameReader()
+        try:
+            while True:
+                raw_message = await self.recv_frame(frames)
+                if raw_message is None:
+                    break
+                try:
+                    request = self.parse(raw_message)
+                except utils.ProtonError as e:
+                    await self.wait_pending()
+                    await self.send(self.get_error_response(e))
+                    continue
+                if self.is_concurrent(request):
+                    await self.in_flight.acquire()
+                    task = loop.create_task(self.process(request))
+                    self.pending.add(task)
+                    task.add_done_callback(self.finish)
+                else:
+                    await self.wait_pending()
+                    await self.process(request)
+        except FrameTooLargeError as e:
+            await self.wait_pending()
+            await self.send(messages.Response(status="ERROR", message=str(e)))
+        except asyncio.TimeoutError:
+            logger.info("Closing idle connection")
+        except OSError:
+            pass
+        finally:
+            await self.wait_pending()
+            self.unsubscribe()
+            if self.pusher is not None:
+                self.pusher.cancel()
+            self.writer.close()
+
+
+def create_ssl_context(certfile=os.path.join(settings.CERTS_DIR, "server.pem"),
+                       keyfile=os.path.join(settings.CERTS_DIR, "server.key")) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # resumption only works when every connection goes through the same context: TLS 1.2 clients
+    # resume from its session cache, TLS 1.3 clients with the tickets it issues after the handshake
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = 2
+    return context
+
+
+def observe_handshake(duration: float, resumed: bool) -> None:
+    metrics.handshakes_total.inc("resumed" if resumed else "full")
+    metrics.handshake_duration.observe(duration)
 
 
 class Server(object):
-    def __init__(self, address=("127.0.0.1", 6666)):
+    def __init__(self, address=("127.0.0.1", 6666), db_name=settings.DATABASE, maintenance=True, reuse_port=False,
+                 ssl_context: Optional[ssl.SSLContext] = None, metrics_port=settings.METRICS_PORT,
+                 media_root=settings.MEDIA_ROOT):
         self.address = address
+        self.db_name = db_name
+        self.maintenance = maintenance
+        self.reuse_port = reuse_port
+        self.ssl_context = ssl_context
+        self.connections = threading.BoundedSemaphore(settings.MAX_CONNECTIONS)
+        self.metrics_port = metrics_port
+        self.media_root = media_root
 
     def get_raw_socket(self) -> socket.socket:
         raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         raw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # lets every worker process bind the same address, the kernel balances connections between them
+            raw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         raw_socket.bind(self.address)
         raw_socket.listen(100)
         return raw_socket
 
+    def get_ssl_context(self) -> ssl.SSLContext:
+        if self.ssl_context is None:
+            self.ssl_context = create_ssl_context()
+        return self.ssl_context
+
     def get_secure_socket(self, raw_socket: socket.socket) -> ssl.SSLSocket:
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        context.load_cert_chain(os.path.join(settings.CERTS_DIR, "server.pem"), os.path.join(settings.CERTS_DIR, "server.key"))
-        ssock = context.wrap_socket(raw_socket, server_side=True)
+        context = self.get_ssl_context()
+        ssock = context.wrap_socket(raw_socket, server_side=True, do_handshake_on_connect=False)
+        start = time.perf_counter()
+        try:
+            ssock.do_handshake()
+        except (OSError, ssl.SSLError):
+            metrics.handshakes_total.inc("failed")
+            ssock.close()
+            raise
+        observe_handshake(time.perf_counter() - start, ssock.session_reused)
         return ssock
 
+    def acquire_connection(self) -> bool:
+        if not self.connections.acquire(blocking=False):
+            return False
+        metrics.active_connections.inc()
+        return True
+
+    def release_connection(self) -> None:
+        metrics.active_connections.dec()
+        self.connections.release()
+
+    def handle_connection(self, conn: socket.socket, c_addr: tuple) -> None:
+        # a client that never finishes its handshake only holds this thread, and only until the timeout
+        conn.settimeout(settings.HANDSHAKE_TIMEOUT or None)
+        # responses go out as several writes (media head, chunks, tail), none of them may wait for a delayed ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            secure_client = self.get_secure_socket(conn)
+        except OSError as e:
+            logger.info(f"Handshake with {c_addr[0]}:{c_addr[1]} failed: {e}")
+            self.release_connection()
+            return
+        secure_client.settimeout(settings.IDLE_TIMEOUT or None)
+        logger.info(f"Connected by {c_addr[0]}:{c_addr[1]} ({describe_tls(secure_client)})")
+        try:
+            ClientThread(secure_client, self.db_name, self.release_connection, self.media_root).start()
+        except Exception as e:
+            response = messages.Response(status="ERROR", message=str(e))
+            send(secure_client, response)
+            secure_client.close()
+            self.release_connection()
+
     def process(self, server_socket: socket.socket):
         try:
             while True:
                 try:
                     conn, c_addr = server_socket.accept()
-                    secure_client = self.get_secure_socket(conn)
-                except Exception as e:
+                except OSError as e:
                     logger.info(str(e))
                     continue
-                try:
-                    logger.info(f"Connected by {c_addr[0]}:{c_addr[1]}")
-                    c = ClientThread(secure_client)
-                    c.start()
-                except Exception as e:
-                    response = messages.Response(status="ERROR", message=str(e))
-                    send(secure_client, response)
-                    secure_client.close()
+                if not self.acquire_connection():
+                    logger.info(f"Refused {c_addr[0]}:{c_addr[1]}, {settings.MAX_CONNECTIONS} connections open")
+                    conn.close()
+                    continue
+                threading.Thread(target=self.handle_connection, args=(conn, c_addr), daemon=True).start()
         except Exception as e:
             logger.info(str(e))
 
+    def start_maintenance(self):
+        if self.maintenance and settings.MAINTENANCE_INTERVAL > 0:
+            MaintenanceThread(self.db_name).start()
+
+    def start_metrics(self):
+        if self.metrics_port:
+            metrics.start_metrics_server((settings.METRICS_HOST, self.metrics_port))
+
+    def start_crypto_pool(self):
+        # before any socket is opened, nothing the server listens on may leak into the pool workers
+        crypto.pool.start()
+
     def runserver(self):
         logger.info(f"Starting server at {self.address[0]}:{self.address[1]}")
+        self.start_crypto_pool()
+        self.start_maintenance()
+        self.start_metrics()
+        self.get_ssl_context()
         server_socket = self.get_raw_socket()
         self.process(server_socket)
+
+
+class AsyncServer(Server):
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        host, port = writer.get_extra_info("peername")[:2]
+        # handle_client only runs on the loop thread, the semaphore never blocks here
+        if not self.acquire_connection():
+            logger.info(f"Refused {host}:{port}, {settings.MAX_CONNECTIONS} connections open")
+            writer.close()
+            return
+        try:
+            start = time.perf_counter()
+            try:
+                writer = await self.start_tls(reader, writer)
+            except OSError as e:
+                metrics.handshakes_total.inc("failed")
+                logger.info(f"Handshake with {host}:{port} failed: {e}")
+                writer.close()
+                return
+            ssl_object = writer.get_extra_info("ssl_object")
+            observe_handshake(time.perf_counter() - start, ssl_object.session_reused)
+            logger.info(f"Connected by {host}:{port} ({describe_tls(ssl_object)})")
+            await AsyncClient(reader, writer, self.db_name, self.media_root).run()
+        finally:
+            self.release_connection()
+
+    async def start_tls(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> asyncio.StreamWriter:
+        timeout = settings.HANDSHAKE_TIMEOUT or None
+        if hasattr(writer, "start_tls"):
+            await writer.start_tls(self.get_ssl_context(), ssl_handshake_timeout=timeout)
+            return writer
+        # streams can only be upgraded since Python 3.11: the transport is upgraded with loop.start_tls, the
+        # protocol keeps feeding the same reader and a new writer is built for the encrypted transport
+        loop = asyncio.get_running_loop()
+        protocol = writer.transport.get_protocol()
+        transport = await loop.start_tls(writer.transport, protocol, self.get_ssl_context(), server_side=True,
+                                         ssl_handshake_timeout=timeout)
+        # what StreamWriter.start_tls does too, a TLS close_notify then closes the connection without a warning
+        protocol._over_ssl = True
+        return asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def start(self) -> asyncio.AbstractServer:
+        # connections are accepted as plain TCP and upgraded in handle_client, only after they got a slot,
+        # so clients beyond MAX_CONNECTIONS never cost a handshake
+        return await asyncio.start_server(self.handle_client, *self.address, backlog=100, reuse_address=True,
+                                          reuse_port=self.reuse_port or None)
+
+    async def serve(self) -> None:
+        self.get_ssl_context()
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    def runserver(self):
+        logger.info(f"Starting async server at {self.address[0]}:{self.address[1]}")
+        self.start_crypto_pool()
+        self.start_maintenance()
+        self.start_metrics()
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            logger.info(str(e))
@@ -0,0 +1,111 @@
+import multiprocessing
+import signal
+import socket
+import time
+from multiprocessing import connection
+
+import settings
+import utils
+from backend.maintenance import MaintenanceThread
+from utils import logger
+
+
+def run_worker(server_class, address, db_name, index):
+    # every worker rotates its own log file, processes must not rename files under each other
+    utils.logger.filename_prefix = f"{utils.logger.filename_prefix}-w{index}"
+    # metrics are collected per process, so each worker serves them on its own port
+    metrics_port = settings.METRICS_PORT + index if settings.METRICS_PORT else 0
+    server = server_class(address, db_name, maintenance=False, reuse_port=True, metrics_port=metrics_port)
+    server.runserver()
+
+
+class Supervisor(object):
+    """Runs N server processes bound to the same address with SO_REUSEPORT and restarts the ones that die."""
+
+    # a worker that exits sooner than this after its start counts as a failed start
+    min_uptime = 10
+    # restarts after failed starts are delayed, the delay doubles with each one up to max_backoff
+    backoff = 0.5
+    max_backoff = 30
+    # failed starts of one worker in a row after which the supervisor gives up
+    max_failures = 5
+
+    def __init__(self, server_class, address=("127.0.0.1", 6666), workers=2, db_name=settings.DATABASE):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise utils.ProtonError("Multiple workers require SO_REUSEPORT support.")
+        self.server_class = server_class
+        self.address = address
+        self.workers = workers
+        self.db_name = db_name
+        # spawn instead of fork, workers must not inherit sqlite connections or threads of the supervisor
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.started = [0.0] * workers
+        self.failures = [0] * workers
+        self.restart_at = [None] * workers
+        self.stopping = False
+
+    def check(self):
+        # a missing certificate or a taken address would kill every worker right after its start,
+        # they are checked once here and the supervisor fails instead of restarting workers forever
+        server = self.server_class(self.address, self.db_name, maintenance=False, reuse_port=True, metrics_port=0)
+        server.get_ssl_context()
+        server.get_raw_socket().close()
+
+    def spawn(self, index):
+        process = self.context.Process(target=run_worker, name=f"proton-worker-{index}",
+                                       args=(self.server_class, self.address, self.db_name, index))
+        process.start()
+        self.started[index] = time.monotonic()
+        self.restart_at[index] = None
+        logger.info(f"Started worker {index} (pid {process.pid})")
+        return process
+
+    def schedule_restart(self, index, process):
+        if time.monotonic() - self.started[index] < self.min_uptime:
+            self.failures[index] += 1
+        else:
+            self.failures[index] = 0
+        failures = self.failures[index]
+        if failures >= self.max_failures:
+            raise utils.ProtonError(f"Worker {index} failed to start {failures} times in a row, giving up")
+        delay = min(self.backoff * 2 ** (failures - 1), self.max_backoff) if failures else 0
+        logger.info(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                    f"restarting in {delay:.1f}s")
+        self.restart_at[index] = time.monotonic() + delay
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def supervise(self):
+        while not self.stopping:
+            now = time.monotonic()
+            waiting = [at for at in self.restart_at if at is not None]
+            timeout = min([1.0] + [max(at - now, 0) for at in waiting])
+            connection.wait([process.sentinel for process in self.processes if process.is_alive()], timeout=timeout)
+            for index, process in enumerate(self.processes):
+                if self.stopping:
+                    break
+                if self.restart_at[index] is not None:
+                    if time.monotonic() >= self.restart_at[index]:
+                        self.processes[index] = self.spawn(index)
+                elif not process.is_alive():
+                    self.schedule_restart(index, process)
+
+    def runserver(self):
+        logger.info(f"Starting {self.workers} workers at {self.address[0]}:{self.address[1]}")
+        self.check()
+        signal.signal(signal.SIGTERM, self.stop)
+        if settings.MAINTENANCE_INTERVAL > 0:
+            MaintenanceThread(self.db_name).start()
+        self.processes = [self.spawn(index) for index in range(self.workers)]
+        try:
+            self.supervise()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join()
+            logger.info("All workers stopped")
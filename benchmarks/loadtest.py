@@ -0,0 +1,272 @@
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import ssl
+import tempfile
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import utils
+from backend import crypto
+from backend.server import AsyncServer, Server, create_ssl_context
+
+DEFAULT_MIX = "get=60,media=15,create=10,alter=8,delete=5,login=2"
+# requests.json only carries placeholders, the replayed posts use the real test image
+IMAGE_PATH = os.path.join("test_assets", "corgi.jpeg")
+
+
+class LoadClient(threading.Thread):
+    """One TLS connection replaying the sample requests in random order, weighted by the mix."""
+
+    user_ids = itertools.count()
+
+    def __init__(self, address, context, templates, mix, image, deadline, seed):
+        super().__init__(daemon=True)
+        self.address = address
+        self.context = context
+        self.templates = templates
+        self.actions = list(mix)
+        self.weights = list(mix.values())
+        self.image = image
+        self.deadline = deadline
+        self.random = random.Random(seed)
+        self.credentials = {"username": f"load_{next(self.user_ids)}_{seed}", "password": "passwd"}
+        self.posts = []
+        self.media_ids = []
+        self.latencies = {}
+        self.errors = {}
+        self.failure = None
+
+    def call(self, action, params=None):
+        request = dict(self.templates.get(action, {"action": action}))
+        if params is not None:
+            request["params"] = params
+        start = time.perf_counter()
+        self.sock.sendall(json.dumps(request).encode() + b"\r\n")
+        line = self.reader.readline()
+        elapsed = time.perf_counter() - start
+        if not line:
+            raise ConnectionError("Server closed the connection.")
+        response = json.loads(line)
+        self.latencies.setdefault(action, []).append(elapsed)
+        # WRONG is a regular answer (e.g. nothing to list yet), only ERROR counts as a failure
+        if response["status"] == "ERROR":
+            self.errors[action] = self.errors.get(action, 0) + 1
+        return response
+
+    def remember(self, response):
+        if response["status"] == "OK":
+            post = response["data"][0]
+            self.posts.append(post["id"])
+            self.media_ids.append(post["image"])
+
+    def get_params(self, action):
+        # actions that need an existing post fall back to creating one, like a real client would
+        if action in ("alter", "delete", "media") and not self.posts:
+            action = "create"
+        if action == "create":
+            params = dict(self.templates["create"]["params"], image=self.image)
+        elif action == "alter":
+            params = dict(self.templates["alter"]["params"], id=self.random.choice(self.posts), image=self.image)
+        elif action == "delete":
+            params = {"id": self.posts.pop(self.random.randrange(len(self.posts)))}
+        elif action == "media":
+            params = {"id": self.random.choice(self.media_ids)}
+        elif action == "login":
+            params = self.credentials
+        else:
+            params = {"limit": 20}
+        return action, params
+
+    def run(self):
+        try:
+            raw_socket = socket.create_connection(self.address)
+            # requests go out in several TLS records, without this the client itself waits for delayed ACKs
+            raw_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = self.context.wrap_socket(raw_socket)
+            with self.sock:
+                self.reader = self.sock.makefile("rb")
+                self.call("register", self.credentials)
+                self.call("login", self.credentials)
+                while time.perf_counter() < self.deadline:
+                    action, params = self.get_params(self.random.choices(self.actions, self.weights)[0])
+                    response = self.call(action, params)
+                    if action == "create":
+                        self.remember(response)
+        except Exception as e:
+            self.failure = e
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        action, weight = item.split("=")
+        weights[action.strip()] = float(weight)
+    unknown = set(weights) - {"get", "media", "create", "alter", "delete", "login"}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unsupported actions in mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(clients, duration):
+    latencies = {}
+    errors = {}
+    for client in clients:
+        for action, values in client.latencies.items():
+            latencies.setdefault(action, []).extend(values)
+        for action, count in client.errors.items():
+            errors[action] = errors.get(action, 0) + count
+    results = {}
+    for action, values in sorted(latencies.items()):
+        values.sort()
+        results[action] = {
+            "requests": len(values),
+            "errors": errors.get(action, 0),
+            "rps": len(values) / duration,
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    return results
+
+
+def print_results(results, duration):
+    print(f"{'action':10} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for action, row in results.items():
+        print(f"{action:10} {row['requests']:9d} {row['errors']:7d} {row['rps']:9.1f} "
+              f"{row['p50_ms']:8.2f} {row['p95_ms']:8.2f} {row['p99_ms']:8.2f}")
+    total = sum(row["requests"] for row in results.values())
+    print(f"{'total':10} {total:9d} {'':7} {total / duration:9.1f}")
+
+
+def generate_certificate(certfile, keyfile, hostname="localhost", days=30):
+    # self-signed, for the throwaway servers of this tool and the tests only
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=days))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname)]), critical=False)
+        .sign(key, hashes.SHA256(), default_backend())
+    )
+    with open(certfile, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+
+
+def get_free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(address, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection(address).close()
+            return
+        except ConnectionRefusedError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_clients(args, address, certfile, templates, image):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(certfile)
+    context.check_hostname = False
+    deadline = time.perf_counter() + args.duration
+    clients = [LoadClient(address, context, templates, args.mix, image, deadline, args.seed * 1000 + number)
+               for number in range(args.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return clients, time.perf_counter() - start
+
+
+def serve(engine, address, db_name, certfile, keyfile, media_root):
+    # runs in its own process, so the server and the clients do not share one GIL
+    utils.logger.echo = False
+    # terminate() then stops the server like Ctrl+C, so the crypto workers are shut down too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server_class = AsyncServer if engine == "async" else Server
+    server = server_class(address, db_name, maintenance=False, ssl_context=create_ssl_context(certfile, keyfile),
+                          metrics_port=0, media_root=media_root)
+    try:
+        server.runserver()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        crypto.pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay sample requests against a local server and report latencies.")
+    parser.add_argument("-c", "--clients", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10, help="seconds of load per client")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help=f"action weights, default {DEFAULT_MIX}")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with open("requests.json", "r") as file:
+        templates = {request["action"]: request for request in json.load(file)}
+    image = utils.get_image_base64(IMAGE_PATH)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_name = os.path.join(tmp_dir, "load.db")
+        certfile, keyfile = os.path.join(tmp_dir, "server.pem"), os.path.join(tmp_dir, "server.key")
+        utils.create_db(db_name)
+        generate_certificate(certfile, keyfile)
+        address = ("127.0.0.1", get_free_port("127.0.0.1"))
+        server = multiprocessing.get_context("spawn").Process(
+            target=serve, args=(args.engine, address, db_name, certfile, keyfile, os.path.join(tmp_dir, "media")))
+        server.start()
+        try:
+            wait_for_server(address)
+            clients, duration = run_clients(args, address, certfile, templates, image)
+        finally:
+            server.terminate()
+            server.join()
+
+    for client in clients:
+        if client.failure is not None:
+            print(f"client {client.credentials['username']} failed: {client.failure!r}")
+    results = summarize(clients, duration)
+    print_results(results, duration)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"engine": args.engine, "clients": args.clients, "duration": duration, "actions": results},
+                      file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import utils
+from backend import crypto
+from core.controllers import Controller
+from core.messages import Request
+
+
+def run_logins(controller, request, count, derive_every_time):
+    start = time.perf_counter()
+    for _ in range(count):
+        if derive_every_time:
+            # reproduces the old behaviour of running PBKDF2 on every encrypt/decrypt
+            crypto.get_fernet.cache_clear()
+        response = controller.login(request)
+        assert response.status == "OK", response.message
+    elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure login throughput with and without the cached Fernet key.")
+    parser.add_argument("-n", "--logins", type=int, default=50)
+    args = parser.parse_args()
+    # run the crypto inline: the key cache cleared here is the one the logins actually use,
+    # pool workers would keep their own derived keys and make the first run look cached
+    crypto.pool.workers = 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_name = os.path.join(tmp_dir, "bench.db")
+        utils.create_db(db_name)
+        controller = Controller(None, db_name)
+        credentials = {"username": "bench", "password": "bench"}
+        controller.register(Request(json.dumps({"action": "register", "params": credentials})))
+        request = Request(json.dumps({"action": "login", "params": credentials}))
+
+        uncached = run_logins(controller, request, args.logins, derive_every_time=True)
+        cached = run_logins(controller, request, args.logins, derive_every_time=False)
+
+    print(f"derived per call: {uncached:10.1f} logins/s")
+    print(f"cached key:       {cached:10.1f} logins/s")
+    print(f"speedup:          {cached / uncached:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
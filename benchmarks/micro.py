@@ -0,0 +1,211 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import utils
+from backend import crypto
+from core import models
+from core.messages import ModelResponse, Request
+
+BENCHMARKS = []
+
+
+def benchmark(name, number=1000):
+    def decorator(setup):
+        BENCHMARKS.append((name, number, setup))
+        return setup
+    return decorator
+
+
+def measure(fn, number, repeat):
+    # the fastest repeat is the one least disturbed by the rest of the machine
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+class Environment(object):
+    """A throwaway database with one user, a valid token and a table of posts."""
+
+    def __init__(self, tmp_dir, repeat, posts=10000):
+        self.tmp_dir = tmp_dir
+        self.repeat = repeat
+        self.db_name = os.path.join(tmp_dir, "micro.db")
+        utils.create_db(self.db_name)
+        self.user_model = models.User(self.db_name)
+        self.post_model = models.Post(self.db_name)
+        self.auth_model = models.AuthToken(self.db_name)
+        self.user_id = self.user_model.create(username="bench", password="bench")[0]
+        self.token = self.auth_model.create(user_id=self.user_id)[2]
+        self.image = utils.get_image_base64(os.path.join("test_assets", "corgi.jpeg"))
+        self.logger = utils.Logger(os.path.join(tmp_dir, "logs"), max_log_dir_size=10 ** 9)
+        self.populate(posts)
+
+    def populate(self, count, title="title"):
+        rows = [("0" * 64, "Lorem ipsum dolor sit amet. " * 8, f"{title} {number}", self.user_id)
+                for number in range(count)]
+        with self.post_model.transaction():
+            self.post_model.conn.executemany(
+                f"INSERT INTO {self.post_model.table_name}(image, content, title, user_id) VALUES(?, ?, ?, ?)", rows)
+        return [row[0] for row in self.post_model.conn.execute(
+            f"SELECT id FROM {self.post_model.table_name} WHERE title LIKE ? ORDER BY id", (f"{title} %",))]
+
+
+@benchmark("request.parse", number=20000)
+def request_parse(env):
+    raw = json.dumps({"action": "alter", "id": 7, "params": {"id": 1, "title": "t", "content": "c"}})
+    return lambda: Request(raw)
+
+
+@benchmark("request.parse_image", number=200)
+def request_parse_image(env):
+    raw = json.dumps({"action": "create", "params": {"title": "t", "content": "c", "image": env.image}})
+    return lambda: Request(raw)
+
+
+def model_response(rows):
+    def setup(env):
+        instances = env.post_model.paginate(limit=rows)
+        return lambda: ModelResponse("OK", env.post_model, instances, action="get")
+    return setup
+
+
+benchmark("response.model_1", number=20000)(model_response(1))
+benchmark("response.model_100", number=500)(model_response(100))
+benchmark("response.model_10000", number=5)(model_response(10000))
+
+
+@benchmark("crypto.encrypt", number=2000)
+def crypto_encrypt(env):
+    return lambda: crypto.encrypt("passwd")
+
+
+@benchmark("crypto.compare", number=2000)
+def crypto_compare(env):
+    encrypted = crypto.encrypt("passwd")
+    return lambda: crypto.compare("passwd", encrypted)
+
+
+@benchmark("model.create", number=1000)
+def model_create(env):
+    return lambda: env.post_model.create(image="0" * 64, content="content", title="created", user_id=env.user_id)
+
+
+@benchmark("model.first", number=5000)
+def model_first(env):
+    return lambda: env.post_model.first(id=5000)
+
+
+@benchmark("model.filter", number=2000)
+def model_filter(env):
+    return lambda: env.post_model.filter(user_id=env.user_id, title="title 5000")
+
+
+@benchmark("model.paginate", number=500)
+def model_paginate(env):
+    return lambda: env.post_model.paginate(limit=20, after_id=5000)
+
+
+@benchmark("model.update", number=1000)
+def model_update(env):
+    return lambda: env.post_model.update(data={"content": "updated"}, where={"id": 5000})
+
+
+@benchmark("model.delete", number=500)
+def model_delete(env):
+    # every call removes a different, existing row
+    ids = iter(env.populate(500 * env.repeat, title="doomed"))
+    return lambda: env.post_model.delete(id=next(ids))
+
+
+def auth_check(cached):
+    def setup(env):
+        controller = type("BenchController", (), {"auth_token": env.token, "db_name": env.db_name,
+                                                  "user_id": None})()
+        check = utils.validate_auth(lambda controller, message: controller.user_id)
+
+        def run():
+            if not cached:
+                utils.token_cache.clear()
+            return check(controller, None)
+        return run
+    return setup
+
+
+benchmark("auth.validate_cached", number=20000)(auth_check(cached=True))
+benchmark("auth.validate_uncached", number=2000)(auth_check(cached=False))
+
+
+@benchmark("logger.write", number=20000)
+def logger_write(env):
+    return lambda: env.logger._write("127.0.0.1:50000 | OK:  | GET")
+
+
+def run_benchmarks(names, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = Environment(tmp_dir, repeat)
+        for name, number, setup in BENCHMARKS:
+            if names and not any(name.startswith(prefix) for prefix in names):
+                continue
+            fn = setup(env)
+            # the logger writer prints every record, keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds = measure(fn, number, repeat)
+                env.logger.flush()
+            results[name] = {"seconds": seconds, "ops_per_sec": 1 / seconds, "number": number}
+            print(f"{name:28} {seconds * 1e6:12.2f} us {1 / seconds:14.1f} ops/s")
+        utils.connections.invalidate(env.db_name)
+    return results
+
+
+def compare(results, baseline, threshold):
+    slower = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        flag = "SLOWER" if ratio > 1 + threshold else ""
+        print(f"{name:28} {ratio:8.2f}x {flag}")
+        if flag:
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the per-request hot path components without a server.")
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name starts with one of these")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown, 0.1 means 10%%")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names, args.repeat)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"created": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+                       "results": results}, file, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)["results"]
+        print(f"\ncompared to {args.compare} (threshold {args.threshold:.0%}):")
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print(f"{len(slower)} benchmark(s) slower than the threshold: {', '.join(slower)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
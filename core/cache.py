@@ -0,0 +1,136 @@
+import collections
+import sqlite3
+import threading
+import time
+
+import settings
+
+
+class PostCache(object):
+    """Keeps JSON-encoded post records and the encoded full listing, so hot reads skip sqlite and json.dumps."""
+
+    def __init__(self, max_size=settings.POST_CACHE_SIZE, ttl=settings.POST_CACHE_TTL,
+                 check_interval=settings.POST_CACHE_CHECK_INTERVAL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.records = collections.OrderedDict()
+        self.listings = {}
+        # bumped on every invalidation, a reader that started before a write must not store what it read
+        self.generations = collections.defaultdict(int)
+        # writes of other server processes are never invalidated here, a watcher connection per database notices
+        # them: triggers bump post_version on every post write, other tables leave the cache alone
+        self.check_interval = check_interval
+        self.watchers = {}
+        self.post_versions = {}
+        self.checked_at = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # the watcher query runs under its own lock, so it never holds up lookups waiting for the cache lock
+        self.watch_lock = threading.Lock()
+
+    def generation(self, db_name):
+        with self.lock:
+            return self.generations[db_name]
+
+    def lookup(self, entries, key):
+        entry = entries.get(key)
+        if entry is not None and time.monotonic() >= entry[1]:
+            del entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def check_post_version(self, db_name):
+        # called without the lock, at most once per check_interval and database
+        if time.monotonic() < self.checked_at.get(db_name, float("-inf")) + self.check_interval:
+            return
+        with self.watch_lock:
+            now = time.monotonic()
+            if now < self.checked_at.get(db_name, float("-inf")) + self.check_interval:
+                return
+            self.checked_at[db_name] = now
+            watcher = self.watchers.get(db_name)
+            if watcher is None:
+                watcher = self.watchers[db_name] = sqlite3.connect(db_name, check_same_thread=False,
+                                                                   isolation_level=None)
+            version = watcher.execute("SELECT version FROM post_version").fetchone()[0]
+            if version == self.post_versions.get(db_name):
+                return
+            self.post_versions[db_name] = version
+        with self.lock:
+            self.drop(db_name)
+
+    def get_record(self, db_name, post_id):
+        key = (db_name, post_id)
+        self.check_post_version(db_name)
+        with self.lock:
+            encoded = self.lookup(self.records, key)
+            if encoded is not None:
+                self.records.move_to_end(key)
+            return encoded
+
+    def set_records(self, db_name, records, generation):
+        # records are (post_id, encoded) pairs
+        with self.lock:
+            if self.generations[db_name] != generation:
+                return
+            valid_until = time.monotonic() + self.ttl
+            for post_id, encoded in records:
+                key = (db_name, post_id)
+                self.records[key] = (encoded, valid_until)
+                self.records.move_to_end(key)
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+
+    def get_listing(self, db_name):
+        self.check_post_version(db_name)
+        with self.lock:
+            return self.lookup(self.listings, db_name)
+
+    def set_listing(self, db_name, encoded, generation):
+        with self.lock:
+            if self.generations[db_name] == generation:
+                self.listings[db_name] = (encoded, time.monotonic() + self.ttl)
+
+    def invalidate(self, db_name, post_id=None):
+        # a new post only changes the listing, altered and deleted ones also drop their record
+        with self.lock:
+            self.generations[db_name] += 1
+            self.listings.pop(db_name, None)
+            if post_id is not None:
+                self.records.pop((db_name, post_id), None)
+
+    def drop(self, db_name):
+        self.generations[db_name] += 1
+        self.listings.pop(db_name, None)
+        for key in [key for key in self.records if key[0] == db_name]:
+            del self.records[key]
+
+    def invalidate_all(self, db_name):
+        with self.lock:
+            self.drop(db_name)
+        # the database file may be replaced, the watcher reconnects on the next lookup
+        with self.watch_lock:
+            watcher = self.watchers.pop(db_name, None)
+            if watcher is not None:
+                watcher.close()
+            self.post_versions.pop(db_name, None)
+            self.checked_at.pop(db_name, None)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.listings.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "records": len(self.records),
+                    "listings": len(self.listings)}
+
+
+post_cache = PostCache()
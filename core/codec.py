@@ -0,0 +1,53 @@
+import json
+import re
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson raises its own subclass, callers only need to catch this one
+DecodeError = json.JSONDecodeError
+
+if orjson is not None:
+    name = "orjson"
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+else:
+    name = "json"
+    # same output as orjson, so responses do not depend on which codec is installed
+    encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+    surrogate = re.compile("[\ud800-\udfff]")
+
+    def reject_surrogates(obj: Any) -> None:
+        # a lone surrogate could never be encoded back to UTF-8, orjson refuses it while parsing already
+        if isinstance(obj, str):
+            if surrogate.search(obj):
+                raise DecodeError("Lone surrogate in string", "", 0)
+        elif isinstance(obj, dict):
+            for key, value in obj.items():
+                reject_surrogates(key)
+                reject_surrogates(value)
+        elif isinstance(obj, list):
+            for item in obj:
+                reject_surrogates(item)
+
+    def loads(data: Union[bytes, str]) -> Any:
+        if isinstance(data, str):
+            try:
+                data = data.encode()
+            except UnicodeEncodeError:
+                raise DecodeError("str is not valid UTF-8: surrogates not allowed", "", 0)
+        obj = json.loads(data)
+        # surrogates only come from \\u escapes, valid pairs are already joined into one character
+        if b"\\ud" in data or b"\\uD" in data:
+            reject_surrogates(obj)
+        return obj
+
+    def dumps(obj: Any) -> bytes:
+        return encoder.encode(obj).encode()
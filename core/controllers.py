@@ -1,27 +1,47 @@
+import itertools
+import sqlite3
+
 import settings
-from core import models
-from backend import crypto
-from utils import validate_auth
+from core import codec, models, media
+from core.cache import post_cache
+from backend import crypto, metrics
+from utils import validate_auth, token_cache, ProtonError
+
+from core.messages import ACTIONS, Request, ModelResponse, Response, StreamingModelResponse, MediaResponse, \
+    EncodedResponse
+from backend.hub import hub
+
 
-from core.messages import ModelResponse, Response
+class BatchAborted(Exception):
+    pass
 
 
 class Controller(object):
+    batch_actions = ("create", "alter", "delete", "get")
 
-    def __init__(self, auth_token, db_name=settings.DATABASE):
+    def __init__(self, auth_token, db_name=settings.DATABASE, media_root=settings.MEDIA_ROOT):
         self.auth_token = auth_token
+        self.user_id = None
         self.db_name = db_name
+        self.media_store = media.MediaStore(media_root)
         self.post_model = models.Post(self.db_name)
         self.user_model = models.User(self.db_name)
         self.auth_model = models.AuthToken(self.db_name)
+        self.pending_events = []
+        # batch sub-requests whose image was already stored, their params hold the media id
+        self.prepared = set()
+
+    def dispatch(self, request):
+        return self.handlers[request.action](self, request)
 
     def _get_token(self, user_id):
-        token = self.auth_model.first(user_id=user_id)
-        if token:
-            token = self.auth_model.update(data={"expires": self.auth_model.get_fresh_expiration()},
-                                           where={"user_id": user_id})
-        else:
-            token = self.auth_model.create(user_id=user_id)
+        with self.auth_model.transaction():
+            token = self.auth_model.first(user_id=user_id)
+            if token:
+                token = self.auth_model.update(data={"expires": self.auth_model.get_fresh_expiration()},
+                                               where={"user_id": user_id})
+            else:
+                token = self.auth_model.create(user_id=user_id)
         return token
 
     def register(self, request):
@@ -32,7 +52,13 @@ class Controller(object):
 
         username = params.get("username")
         password = params.get("password")
-        self.user_model.create(username=username, password=password)
+        try:
+            self.user_model.create(username=username, password=password)
+        except crypto.PoolBusyError as e:
+            return Response(status="ERROR", message=str(e), action="register")
+        except sqlite3.IntegrityError:
+            # a concurrent registration took the name between the check above and the insert
+            return Response(status="ERROR", message="Given user already exists.", action="register")
         users = self.user_model.first(username=username)
         return ModelResponse("OK", self.user_model, users, action="register")
 
@@ -41,50 +67,275 @@ class Controller(object):
         username = params["username"]
         password = params["password"]
         user = self.user_model.first(username=username)
-        if not user or not crypto.compare(password, user[2]):
+        try:
+            is_valid = user is not None and crypto.pool.run(crypto.compare, password, user[2])
+        except crypto.PoolBusyError as e:
+            return Response(status="ERROR", message=str(e), action="login")
+        if not is_valid:
             return Response(status="ERROR", message="Incorrect username or/and password.", action="login")
 
         token = self._get_token(user[0])
+        self.auth_token = token[2]
+        token_cache.set(self.db_name, token[2], token[1], self.auth_model.get_timestamp(token[3]))
         return ModelResponse("OK", self.auth_model, token, action="login")
 
     @validate_auth
     def logout(self, request):
         token = self.auth_token
         self.auth_model.delete(token=token)
+        token_cache.invalidate(self.db_name, token)
+        self.auth_token = None
         return Response("OK", action="logout")
 
+    def _store_image(self, image):
+        # posts only keep a reference, the image itself is served by the media action
+        if not image:
+            return image
+        return self.media_store.save_base64(image)
+
+    def _take_image(self, request):
+        if request in self.prepared:
+            return request.params["image"]
+        return self._store_image(request.params.get("image"))
+
+    def _prepare_images(self, requests):
+        # decoding and writing images must not happen while the batch holds the database write lock
+        created = []
+        for request in requests:
+            if request.action not in ("create", "alter") or not request.params.get("image"):
+                continue
+            try:
+                media_id, is_new = self.media_store.store_base64(request.params["image"])
+            except ProtonError:
+                # left to the handler, which reports it as the failing operation
+                continue
+            request.params["image"] = media_id
+            self.prepared.add(request)
+            if is_new:
+                created.append(media_id)
+        return created
+
+    def _discard_images(self, media_ids):
+        # files are shared by content, one a committed post picked up in the meantime has to stay
+        for media_id in media_ids:
+            if self.post_model.first(image=media_id) is None:
+                self.media_store.remove(media_id)
+
     @validate_auth
     def create(self, request):
-        user_id = self.auth_model.first(token=self.auth_token)[1]
-        post = self.post_model.create(user_id=user_id, **request.params)
-        return ModelResponse(status="OK", model=self.post_model, raw_instance=post, action="create")
+        params = request.params
+        try:
+            params["image"] = self._take_image(request)
+        except ProtonError as e:
+            return Response("ERROR", str(e), action="create")
+        post = self.post_model.create(user_id=self.user_id, **params)
+        self._invalidate_posts()
+        response = ModelResponse(status="OK", model=self.post_model, raw_instance=post, action="create")
+        self._publish("create", response.data[0])
+        return response
+
+    def _stream_posts(self, after_id, fields):
+        # a slow reader must not keep a sqlite read snapshot open (it stops WAL checkpoints), the posts are
+        # read in pages and each page is fully fetched before it is written out
+        rows = self.post_model.iter_rows(settings.MAX_PAGE_SIZE, after_id=after_id, fields=fields)
+        try:
+            first = next(rows, None)
+        except ProtonError as e:
+            return Response("ERROR", str(e), action="get")
+        if first is None:
+            return Response("WRONG", "Not Found.", action="get")
+        fields = self.post_model.get_projection(fields) if fields is not None else None
+        return StreamingModelResponse("OK", self.post_model, itertools.chain([first], rows), action="get",
+                                      fields=fields)
+
+    def _invalidate_posts(self, post_id=None):
+        # ids may arrive as strings, sqlite still matches them against the integer column
+        try:
+            post_id = int(post_id) if post_id is not None else None
+        except (TypeError, ValueError):
+            post_id = None
+        post_cache.invalidate(self.db_name, post_id)
+
+    def _publish(self, op, post):
+        event = {"op": op, "id": post["id"]}
+        if "title" in post:
+            event["title"] = post["title"]
+        # changes made inside a batch are announced once it is committed
+        if self.post_model.conn.transaction_depth:
+            self.pending_events.append(event)
+        else:
+            hub.publish(self.db_name, event)
+
+    def _use_post_cache(self):
+        # inside a batch the connection sees its own uncommitted writes, they must not end up in the cache
+        return self.post_model.conn.transaction_depth == 0
+
+    def _cached_post(self, post_id):
+        encoded = post_cache.get_record(self.db_name, post_id)
+        if encoded is not None:
+            return EncodedResponse("OK", b"[" + encoded + b"]", action="get")
+        generation = post_cache.generation(self.db_name)
+        instance = self.post_model.first(id=post_id)
+        if instance is None:
+            return Response("WRONG", "Not Found.", action="get")
+        response = ModelResponse("OK", self.post_model, instance, action="get")
+        post_cache.set_records(self.db_name, [(post_id, codec.dumps(response.data[0]))], generation)
+        return response
+
+    def _cached_listing(self):
+        encoded = post_cache.get_listing(self.db_name)
+        if encoded is not None:
+            return EncodedResponse("OK", encoded, action="get")
+        generation = post_cache.generation(self.db_name)
+        rows = self.post_model.paginate(limit=settings.POST_CACHE_LISTING_ROWS + 1)
+        if not rows:
+            return Response("WRONG", "Not Found.", action="get")
+        if len(rows) > settings.POST_CACHE_LISTING_ROWS:
+            # too long to keep in memory, it is streamed like before
+            rest = self.post_model.iter_rows(settings.MAX_PAGE_SIZE, after_id=rows[-1][0])
+            return StreamingModelResponse("OK", self.post_model, itertools.chain(rows, rest), action="get")
+        records = [codec.dumps(record) for record in StreamingModelResponse("OK", self.post_model, rows).data]
+        encoded = b"[" + b",".join(records) + b"]"
+        post_cache.set_records(self.db_name, [(row[0], record) for row, record in zip(rows, records)], generation)
+        post_cache.set_listing(self.db_name, encoded, generation)
+        return EncodedResponse("OK", encoded, action="get")
 
     @validate_auth
     def get(self, request):
-        instance = None
-        if getattr(request, "params", None) is not None and request.params.get("id", None) is not None:
-            post_id = request.params["id"]
-            if post_id is not None:
-                instance = self.post_model.filter(id=post_id)
-        else:
-            instance = self.post_model.all()
+        params = request.params or {}
+        filters = {"id": params["id"]} if params.get("id") is not None else {}
+        limit = params.get("limit")
+        after_id = params.get("after_id")
+        fields = params.get("fields")
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            return Response("ERROR", "Limit must be a positive integer.", action="get")
+        if after_id is not None and (not isinstance(after_id, int) or isinstance(after_id, bool)):
+            return Response("ERROR", "after_id must be an integer.", action="get")
+        if fields is not None and not (isinstance(fields, list) and all(isinstance(f, str) for f in fields)):
+            return Response("ERROR", "Fields must be a list of column names.", action="get")
+        if limit is not None:
+            limit = min(limit, settings.MAX_PAGE_SIZE)
+
+        if limit is None and after_id is None and fields is None and self._use_post_cache():
+            if not filters:
+                return self._cached_listing()
+            if type(filters["id"]) is int:
+                return self._cached_post(filters["id"])
+
+        if limit is None and not filters:
+            return self._stream_posts(after_id, fields)
+
+        try:
+            # one extra row tells whether there is a next page
+            instance = self.post_model.paginate(limit=limit + 1 if limit else None, after_id=after_id,
+                                                fields=fields, **filters)
+        except ProtonError as e:
+            return Response("ERROR", str(e), action="get")
+        next_cursor = None
+        if limit is not None and len(instance) > limit:
+            instance = instance[:limit]
+            next_cursor = instance[-1][0]
         if instance:
-            return ModelResponse("OK", self.post_model, raw_instance=instance, action="get")
+            fields = self.post_model.get_projection(fields) if fields is not None else None
+            return ModelResponse("OK", self.post_model, raw_instance=instance, action="get", fields=fields,
+                                 next_cursor=next_cursor)
         return Response("WRONG", "Not Found.", action="get")
 
     @validate_auth
     def alter(self, request):
         post_id = request.params.pop("id")
+        if "image" in request.params:
+            try:
+                request.params["image"] = self._take_image(request)
+            except ProtonError as e:
+                return Response("ERROR", str(e), action="alter")
         instance = self.post_model.update(data=request.params, where={"id": post_id})
+        self._invalidate_posts(post_id)
         if instance:
-            return ModelResponse("OK", self.post_model, instance, action="alter")
+            response = ModelResponse("OK", self.post_model, instance, action="alter")
+            self._publish("alter", response.data[0])
+            return response
         return Response("WRONG", "Not Found.", action="alter")
 
     @validate_auth
     def delete(self, request):
         post_id = request.params.pop("id")
         obj = self.post_model.delete(id=post_id)
+        self._invalidate_posts(post_id)
         if obj is None:
             return Response("WRONG", "Not Found.", action="delete")
+        self._publish("delete", {"id": obj[0]})
         return Response("OK", data={"id": post_id}, action="delete")
 
+    @validate_auth
+    def media(self, request):
+        media_id = request.params["id"]
+        try:
+            if not self.media_store.exists(media_id):
+                return Response("WRONG", "Not Found.", action="media")
+        except ProtonError as e:
+            return Response("ERROR", str(e), action="media")
+        return MediaResponse("OK", media_id, self.media_store.iter_base64(media_id), action="media")
+
+    @validate_auth
+    def stats(self, request):
+        user = self.user_model.first(id=self.user_id)
+        if user is None or user[1] not in settings.ADMINS:
+            return Response("ERROR", "Permission denied. Admin account required.", action="stats")
+        data = metrics.registry.snapshot()
+        data["post_cache"] = post_cache.stats()
+        return Response("OK", data=data, action="stats")
+
+    @validate_auth
+    def subscribe(self, request):
+        # the connection registers itself with the hub once this succeeds
+        return Response("OK", "Subscribed.", action="subscribe")
+
+    def unsubscribe(self, request):
+        return Response("OK", "Unsubscribed.", action="unsubscribe")
+
+    @validate_auth
+    def batch(self, request):
+        if len(request.params) > settings.MAX_BATCH_SIZE:
+            return Response("ERROR", f"Batch exceeds {settings.MAX_BATCH_SIZE} operations.", action="batch")
+        try:
+            sub_requests = [Request(None, obj) for obj in request.params]
+        except ProtonError as e:
+            return Response("ERROR", str(e), action="batch")
+        for sub_request in sub_requests:
+            if sub_request.action not in self.batch_actions:
+                return Response("ERROR", f"Action {sub_request.action} is not allowed in batch.", action="batch")
+
+        created_images = self._prepare_images(sub_requests)
+        results = []
+        committed = False
+        try:
+            with self.post_model.transaction():
+                for index, sub_request in enumerate(sub_requests):
+                    # authorization was checked once for the whole batch
+                    response = self.batch_handlers[sub_request.action](self, sub_request)
+                    result = response.get_body(response.data)
+                    if sub_request.id is not None:
+                        result["id"] = sub_request.id
+                    results.append(result)
+                    if response.status == "ERROR":
+                        raise BatchAborted(f"Operation {index} failed: {response.message}")
+            committed = True
+        except BatchAborted as e:
+            self.pending_events.clear()
+            return Response("ERROR", str(e), data=results, action="batch")
+        finally:
+            if not committed:
+                self._discard_images(created_images)
+            # readers may have cached the old rows between an operation and the commit
+            if any(sub_request.action != "get" for sub_request in sub_requests):
+                post_cache.invalidate_all(self.db_name)
+        for event in self.pending_events:
+            hub.publish(self.db_name, event)
+        self.pending_events.clear()
+        return Response("OK", data=results, action="batch")
+
+
+# compiled once at import, a protocol action without a handler fails here instead of on a request
+Controller.handlers = {action: getattr(Controller, action) for action in ACTIONS}
+Controller.batch_handlers = {action: Controller.handlers[action].__wrapped__ for action in Controller.batch_actions}
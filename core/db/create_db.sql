@@ -1,3 +1,5 @@
+pragma auto_vacuum = incremental;
+
 drop table if exists authtoken;
 
 drop table if exists post;
@@ -0,0 +1,23 @@
+drop index if exists authtoken_id_uindex;
+
+drop index if exists post_int_uindex;
+
+drop index if exists user_id_uindex;
+
+-- registration used to check and insert in two steps, so racing clients could create a username twice.
+-- login always picked the oldest row and the later ones were unreachable, they are renamed instead of deleted
+update user
+set username = username || '#' || id
+where id not in (select min(id) from user group by username);
+
+create unique index if not exists user_username_uindex
+    on user (username);
+
+create unique index if not exists authtoken_token_uindex
+    on authtoken (token);
+
+create index if not exists authtoken_user_id_index
+    on authtoken (user_id);
+
+create index if not exists post_user_id_index
+    on post (user_id);
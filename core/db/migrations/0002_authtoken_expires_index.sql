@@ -0,0 +1,2 @@
+create index if not exists authtoken_expires_index
+    on authtoken (expires);
@@ -0,0 +1,31 @@
+-- the post cache polls this counter to notice post writes of other server processes,
+-- unlike PRAGMA data_version it does not move when users log in or tokens expire
+create table if not exists post_version
+(
+    id      integer primary key check (id = 1),
+    version integer not null
+);
+
+insert or ignore into post_version (id, version)
+values (1, 0);
+
+create trigger if not exists post_version_insert
+    after insert
+    on post
+begin
+    update post_version set version = version + 1;
+end;
+
+create trigger if not exists post_version_update
+    after update
+    on post
+begin
+    update post_version set version = version + 1;
+end;
+
+create trigger if not exists post_version_delete
+    after delete
+    on post
+begin
+    update post_version set version = version + 1;
+end;
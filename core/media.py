@@ -0,0 +1,69 @@
+import base64
+import binascii
+import hashlib
+import mmap
+import os
+import string
+from typing import Iterator, Tuple
+from uuid import uuid4
+
+import settings
+import utils
+
+
+class MediaStore(object):
+    """Content addressed image storage, files are named after the sha256 of their content."""
+
+    # multiple of 3, so every chunk encodes to base64 without padding
+    chunk_size = 3 * 2 ** 16
+
+    def __init__(self, root=settings.MEDIA_ROOT):
+        self.root = root
+
+    def get_path(self, media_id: str) -> str:
+        if not isinstance(media_id, str) or len(media_id) != 64 or set(media_id) - set(string.hexdigits.lower()):
+            raise utils.ProtonError("Invalid media id.")
+        return os.path.join(self.root, media_id)
+
+    def exists(self, media_id: str) -> bool:
+        return os.path.isfile(self.get_path(media_id))
+
+    def save_base64(self, image: str) -> str:
+        return self.store_base64(image)[0]
+
+    def store_base64(self, image: str) -> Tuple[str, bool]:
+        """Save the image and tell whether its file was created by this call."""
+        if not isinstance(image, str):
+            raise utils.ProtonError("Invalid image.")
+        if image.startswith("data:"):
+            _, _, image = image.partition(",")
+        try:
+            raw_image = base64.b64decode(image, validate=True)
+        except (binascii.Error, ValueError):
+            raise utils.ProtonError("Invalid image.")
+
+        media_id = hashlib.sha256(raw_image).hexdigest()
+        path = self.get_path(media_id)
+        if os.path.exists(path):
+            return media_id, False
+        os.makedirs(self.root, exist_ok=True)
+        # write aside and rename, concurrent uploads of the same image must not see a partial file
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(raw_image)
+        os.replace(tmp_path, path)
+        return media_id, True
+
+    def remove(self, media_id: str) -> None:
+        try:
+            os.remove(self.get_path(media_id))
+        except FileNotFoundError:
+            pass
+
+    def iter_base64(self, media_id: str) -> Iterator[bytes]:
+        with open(self.get_path(media_id), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                for offset in range(0, len(image), self.chunk_size):
+                    yield base64.b64encode(image[offset:offset + self.chunk_size])
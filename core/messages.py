@@ -1,97 +1,259 @@
-import json
-from typing import Union
+from typing import Iterable, Tuple, Union
 
 import utils
-from core import models
+from core import codec, models
+
+
+def require(condition):
+    if not condition:
+        raise utils.ProtonError("Syntax Error")
+
+
+def expect_params(*required):
+    def validate(params):
+        if params is None:
+            require(not required)
+            return None
+        require(isinstance(params, dict))
+        for name in required:
+            require(name in params)
+        return params
+    return validate
+
+
+def expect_operations(params):
+    require(isinstance(params, list))
+    return params
+
+
+# built once at import, every request only looks its action up here
+ACTIONS = {
+    "register": expect_params("username", "password"),
+    "login": expect_params("username", "password"),
+    "logout": expect_params(),
+    "get": expect_params(),
+    "create": expect_params("content", "title"),
+    "alter": expect_params("id"),
+    "delete": expect_params("id"),
+    "media": expect_params("id"),
+    "batch": expect_operations,
+    "stats": expect_params(),
+    "subscribe": expect_params(),
+    "unsubscribe": expect_params(),
+}
 
 
 class Request(object):
 
-    def __init__(self, json_string):
-        self.required_action_params = {
-            "register": ["username", "password"],
-            "login": ["username", "password"],
-            "logout": None,
-            "get": None,
-            "create": ["content", "title"],
-            "alter": ["id"],
-            "delete": ["id"],
-        }
-        json_string = json_string
+    def __init__(self, json_string: Union[bytes, str, None], obj=None):
         self.json_string = json_string
+        self.id = None
         try:
-            self.obj = self.deserialize_json()
+            # sub-requests of a batch arrive already deserialized
+            self.obj = self.deserialize_json() if obj is None else obj
+            self.id = self.get_id()
             self.action = self.get_action()
             self.params = self.get_params()
-        except (KeyError, AssertionError, json.JSONDecodeError) as e:
-            raise utils.ProtonError("Syntax Error")
+        except (KeyError, TypeError, AttributeError, ValueError, utils.ProtonError):
+            error = utils.ProtonError("Syntax Error")
+            error.request_id = self.id
+            raise error
 
     def deserialize_json(self):
-        obj = json.loads(self.json_string)
+        obj = codec.loads(self.json_string)
         return obj
 
+    def get_id(self):
+        # optional, echoed back in the response so pipelining clients can match responses to requests
+        request_id = self.obj.get("id", None)
+        require(request_id is None or (isinstance(request_id, (str, int)) and not isinstance(request_id, bool)))
+        return request_id
+
     def get_action(self):
         action = self.obj["action"]
-        assert action in self.required_action_params.keys()
+        require(action in ACTIONS)
         return action
 
     def get_params(self):
-        params = self.obj.get("params", None)
-        if isinstance(params, dict):
-            if self.required_action_params[self.action] is not None:
-                for param in self.required_action_params[self.action]:
-                    assert param in params.keys()
-        else:
-            assert params is None
-            assert self.required_action_params.get(self.action, None) is None
-        return params
+        return ACTIONS[self.action](self.obj.get("params", None))
+
 
 class Response(object):
-    def __init__(self, status, message=None, data=None, action=""):
+    # streamed responses encode their envelope around this placeholder and write iter_data() in its place
+    placeholder = "\x00data\x00"
+    chunk_size = 2 ** 16
+    streamed = False
+
+    def __init__(self, status, message=None, data=None, action="", next_cursor=None):
         self.action = action.upper()
         self.message = message
         self.status = status
         self.data = data
-        self.json_response = None
+        self.next_cursor = next_cursor
+        self.request_id = None
+        self.encoded_response = None
 
         self.construct_json()
 
-    def construct_json(self):
+    @property
+    def data(self):
+        if self.materialized_data is None and self.streamed:
+            self.materialized_data = self.load_data()
+        return self.materialized_data
+
+    @data.setter
+    def data(self, data):
+        self.materialized_data = data
+
+    def get_body(self, data):
         _request = {
             "status": self.status,
             "message": self.message,
-            "data": self.data
+            "data": data,
+            "next_cursor": self.next_cursor,
+            "id": self.request_id
         }
-        request = {key: val for key, val in _request.items() if val is not None}
-        self.json_response = json.dumps(request)
-        self.json_response += "\r\n"
+        return {key: val for key, val in _request.items() if val is not None}
+
+    def construct_json(self):
+        if not self.streamed:
+            self.encoded_response = codec.dumps(self.get_body(self.data)) + b"\r\n"
+
+    @property
+    def json_response(self):
+        return b"".join(self.iter_chunks()).decode()
+
+    def set_request_id(self, request_id):
+        self.request_id = request_id
+        self.construct_json()
+
+    def split_envelope(self, obj) -> Tuple[bytes, bytes]:
+        head, tail = codec.dumps(obj).split(codec.dumps(self.placeholder))
+        return head, tail
+
+    def load_data(self):
+        raise NotImplementedError
+
+    def iter_data(self) -> Iterable[bytes]:
+        raise NotImplementedError
+
+    def iter_chunks(self) -> Iterable[bytes]:
+        if not self.streamed:
+            yield self.encoded_response
+            return
+        if self.materialized_data is not None:
+            # the source was already consumed by reading data, it cannot be iterated a second time
+            yield codec.dumps(self.get_body(self.materialized_data)) + b"\r\n"
+            return
+        head, tail = self.split_envelope(self.get_body(self.placeholder))
+        buffer, size = [head], len(head)
+        for piece in self.iter_data():
+            buffer.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+        buffer.append(tail + b"\r\n")
+        yield b"".join(buffer)
 
     def __repr__(self):
         return self.json_response
 
 
 class ModelResponse(Response):
-    def __init__(self, status, model, raw_instance: Union[list, tuple], message="", action=""):
+    def __init__(self, status, model, raw_instance: Union[list, tuple, Iterable[tuple]], message="", action="",
+                 fields=None, next_cursor=None):
 
         if not isinstance(model, models.Model):
             model = model()
         self.model = model
 
-        if raw_instance and not isinstance(raw_instance[0], tuple):
+        if not self.streamed and raw_instance and not isinstance(raw_instance[0], tuple):
             raw_instance = [raw_instance]
         self.raw_instance = raw_instance
+        self.fields = fields
 
         data = self.create_data()
-        super(ModelResponse, self).__init__(status, message, data=data, action=action)
+        super(ModelResponse, self).__init__(status, message, data=data, action=action, next_cursor=next_cursor)
 
-    def get_record(self, instance, table_schema):
-        return {col_name: val for col_name, val in zip(table_schema, instance) if
-                               col_name not in self.model.write_only}
+    def get_record(self, instance, readable_cols):
+        indexes, names = readable_cols
+        return dict(zip(names, [instance[index] for index in indexes]))
 
-    def create_data(self):
-        table_schema = self.model.get_table_cols()
-        data = []
+    def iter_records(self):
+        readable_cols = self.model.get_readable_cols(self.fields)
         for instance in self.raw_instance:
-            single_obj_data = self.get_record(instance, table_schema)
-            data.append(single_obj_data)
-        return data
+            yield self.get_record(instance, readable_cols)
+
+    def create_data(self):
+        return list(self.iter_records())
+
+
+class StreamingModelResponse(ModelResponse):
+    streamed = True
+
+    def __init__(self, status, model: models.Model, rows: Iterable[tuple], message="", action="", fields=None):
+        # rows are usually read lazily from sqlite, they are serialized while being written to the socket
+        super(StreamingModelResponse, self).__init__(status, model, rows, message=message, action=action,
+                                                     fields=fields)
+
+    def create_data(self):
+        return None
+
+    def load_data(self):
+        return list(self.iter_records())
+
+    def iter_data(self) -> Iterable[bytes]:
+        yield b"["
+        for index, record in enumerate(self.iter_records()):
+            if index:
+                yield b","
+            yield codec.dumps(record)
+        yield b"]"
+
+
+class EncodedResponse(Response):
+    streamed = True
+
+    def __init__(self, status, encoded_data: bytes, message="", action=""):
+        # encoded_data is the JSON text of data, taken from the post cache as it is
+        self.encoded_data = encoded_data
+        super(EncodedResponse, self).__init__(status, message, action=action)
+
+    def load_data(self):
+        return codec.loads(self.encoded_data)
+
+    def iter_data(self) -> Iterable[bytes]:
+        yield self.encoded_data
+
+
+class Notification(Response):
+    # pushed without a request, clients tell it apart from responses by the event field
+    def __init__(self, event, data=None):
+        self.event = event
+        super(Notification, self).__init__("OK", data=data, action="notify")
+
+    def get_body(self, data):
+        body = {"event": self.event}
+        if data is not None:
+            body["data"] = data
+        return body
+
+
+class MediaResponse(Response):
+    streamed = True
+
+    def __init__(self, status, media_id, chunks: Iterable[bytes], message="", action=""):
+        # chunks are base64 encoded pieces of the image file, read lazily while being written
+        self.media_id = media_id
+        self.chunks = chunks
+        super(MediaResponse, self).__init__(status, message, action=action)
+
+    def load_data(self):
+        return {"id": self.media_id, "image": b"".join(self.chunks).decode()}
+
+    def iter_data(self) -> Iterable[bytes]:
+        head, tail = self.split_envelope({"id": self.media_id, "image": self.placeholder})
+        yield head + b'"'
+        yield from self.chunks
+        yield b'"' + tail
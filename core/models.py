@@ -3,10 +3,11 @@ import datetime
 import os
 import sqlite3
 import abc
-from time import strptime
+import contextlib
+import time
 from uuid import uuid4
 
-from backend import crypto
+from backend import crypto, metrics
 import settings
 import utils
 
@@ -14,13 +15,16 @@ import utils
 class Model(abc.ABC):
     fields = []
     write_only = []
+    # (db_name, table_name) -> (columns, readable column indexes, readable column names)
+    schemas = {}
 
     def __init__(self, db_name=settings.DATABASE):
         self.table_name = self.__class__.__name__.lower()
-        self.conn = utils.create_conn(db_name=db_name)
+        self.db_name = db_name
 
-    def __del__(self):
-        self.conn.close()
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return utils.connections.get(self.db_name)
 
     def fetch(self, cursor, many=True):
         results = cursor.fetchall() if many else cursor.fetchone()
@@ -29,7 +33,42 @@ class Model(abc.ABC):
     def get_fields(self):
         return ",".join(self.fields)
 
+    @classmethod
+    def clear_schemas(cls, db_name=None):
+        for key in list(Model.schemas):
+            if db_name is None or key[0] == db_name:
+                del Model.schemas[key]
+
+    def get_schema(self):
+        key = (self.db_name, self.table_name)
+        schema = Model.schemas.get(key)
+        if schema is None:
+            cols = self.load_table_cols()
+            readable = [(index, name) for index, name in enumerate(cols) if name not in self.write_only]
+            schema = (cols, tuple(index for index, _ in readable), tuple(name for _, name in readable))
+            Model.schemas[key] = schema
+        return schema
+
     def get_table_cols(self):
+        return self.get_schema()[0]
+
+    def get_readable_cols(self, fields=None):
+        if fields is None:
+            _, indexes, names = self.get_schema()
+            return indexes, names
+        readable = [(index, name) for index, name in enumerate(fields) if name not in self.write_only]
+        return tuple(index for index, _ in readable), tuple(name for _, name in readable)
+
+    def get_projection(self, fields):
+        # the id is always selected, it is what cursors point at
+        fields = ["id"] + [field for field in fields if field != "id"]
+        cols = self.get_table_cols()
+        unknown = [field for field in fields if field not in cols]
+        if unknown:
+            raise utils.ProtonError(f"Unknown fields: {', '.join(map(str, unknown))}.")
+        return fields
+
+    def load_table_cols(self):
         sql = f"PRAGMA table_info({self.table_name})"
         cursor = self.conn.cursor()
         cursor.execute(sql)
@@ -54,16 +93,39 @@ class Model(abc.ABC):
 
     def execute_sql(self, sql, params=()) -> sqlite3.Cursor:
         cursor = self.conn.cursor()
+        start = time.perf_counter()
         cursor.execute(sql, params)
-        self.conn.commit()
+        metrics.db_query_duration.observe(time.perf_counter() - start)
         return cursor
 
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.conn
+        depth = conn.transaction_depth
+        savepoint = f"sp{depth}"
+        conn.execute("BEGIN IMMEDIATE" if depth == 0 else f"SAVEPOINT {savepoint}")
+        conn.transaction_depth = depth + 1
+        try:
+            yield self
+        except BaseException:
+            conn.transaction_depth = depth
+            if depth == 0:
+                conn.execute("ROLLBACK")
+            else:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+            raise
+        else:
+            conn.transaction_depth = depth
+            conn.execute("COMMIT" if depth == 0 else f"RELEASE {savepoint}")
+
     def create(self, **kwargs):
         placeholder = ",".join("?" * len(self.fields))
         params = [kwargs[field] for field in self.fields]
         sql = f"""INSERT INTO {self.table_name}({self.get_fields()}) VALUES({placeholder})"""
-        self.execute_sql(sql, params)
-        return self.last()
+        with self.transaction():
+            self.execute_sql(sql, params)
+            return self.last()
 
     def all(self):
         sql = f"SELECT * FROM {self.table_name}"
@@ -96,20 +158,48 @@ class Model(abc.ABC):
         objects = self.fetch(cursor, True)
         return objects
 
+    def query(self, limit=None, after_id=None, fields=None, **kwargs) -> sqlite3.Cursor:
+        select = ",".join(self.get_projection(fields)) if fields is not None else "*"
+        conditions = [self.get_conditions(kwargs)] if kwargs else []
+        params = dict(kwargs)
+        if after_id is not None:
+            conditions.append("id > :after_id")
+            params["after_id"] = after_id
+        where = f"WHERE {' and '.join(conditions)}" if conditions else ""
+        # keyset pagination, a negative limit means no limit in sqlite
+        params["limit"] = -1 if limit is None else limit
+        sql = f"SELECT {select} FROM {self.table_name} {where} ORDER BY id LIMIT :limit"
+        return self.execute_sql(sql, params)
+
+    def paginate(self, limit=None, after_id=None, fields=None, **kwargs):
+        cursor = self.query(limit, after_id, fields, **kwargs)
+        return self.fetch(cursor, True)
+
+    def iter_rows(self, page_size, after_id=None, fields=None, **kwargs):
+        """Yield every matching row, read page by page so no statement stays open while the caller waits."""
+        while True:
+            rows = self.paginate(page_size, after_id, fields, **kwargs)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after_id = rows[-1][0]
+
     def update(self, data: dict, where: dict):
         data_placeholder = " = ?, ".join(data.keys()) + " = ?"
         where_placeholder = " = ?, ".join(where.keys()) + " = ?"
         sql = f"UPDATE {self.table_name} SET {data_placeholder} WHERE {where_placeholder}"
         params = list(data.values()) + list(where.values())
-        cursor = self.execute_sql(sql, params)
-        return self.first(**data)
+        with self.transaction():
+            self.execute_sql(sql, params)
+            return self.first(**where)
 
     def delete(self, **kwargs):
-        obj = self.first(**kwargs)
         conditions = self.get_conditions(kwargs)
         sql = f"DELETE FROM {self.table_name} WHERE {conditions}"
-        self.execute_sql(sql, kwargs)
-        return obj
+        with self.transaction():
+            obj = self.first(**kwargs)
+            self.execute_sql(sql, kwargs)
+            return obj
 
 
 class Post(Model):
@@ -121,7 +211,7 @@ class User(Model):
     write_only = ["password"]
 
     def create(self, **kwargs):
-        kwargs["password"] = crypto.encrypt(kwargs.get("password"))
+        kwargs["password"] = crypto.pool.run(crypto.encrypt, kwargs.get("password"))
         return super(User, self).create(**kwargs)
 
 
@@ -138,11 +228,23 @@ class AuthToken(Model):
         expires = self.get_fresh_expiration()
         return super(AuthToken, self).create(token=token, user_id=user_id, expires=expires)
 
+    def get_timestamp(self, expires):
+        return datetime.datetime.fromisoformat(str(expires)).timestamp()
+
+    def delete_expired(self, batch_size=1000):
+        sql = f"DELETE FROM {self.table_name} WHERE id IN " \
+              f"(SELECT id FROM {self.table_name} WHERE expires < ? LIMIT ?)"
+        with self.transaction():
+            cursor = self.execute_sql(sql, (datetime.datetime.now(), batch_size))
+        return cursor.rowcount
+
     def is_valid(self, **kwargs):
         token = self.first(**kwargs)
         if token is None:
             raise utils.ProtonError("Not found.")
-        expires_date = strptime(token[3], "%Y-%m-%d %H:%M:%S.%f")
-        expires = datetime.datetime(year=expires_date.tm_year, month=expires_date.tm_mon, day=expires_date.tm_mday,
-                                    hour=expires_date.tm_hour, minute=expires_date.tm_min, second=expires_date.tm_sec)
-        return datetime.datetime.now() < expires
+        return time.time() < self.get_timestamp(token[3])
+
+
+def load_schemas(db_name=settings.DATABASE):
+    for model_class in Model.__subclasses__():
+        model_class(db_name).get_schema()
@@ -1,10 +1,33 @@
+import argparse
 import os
 
 import utils
-from backend.server import Server
+from backend.server import Server, AsyncServer
+from backend.workers import Supervisor
+from core import models
 import settings
 
-if not os.path.exists(settings.DATABASE):
-    utils.create_db(settings.DATABASE)
-server = Server((settings.HOST, settings.PORT))
-server.runserver()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Proton server.")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads",
+                        help="threads: one thread per connection, async: single asyncio event loop")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes sharing the port with SO_REUSEPORT")
+    args = parser.parse_args()
+
+    if not os.path.exists(settings.DATABASE):
+        utils.create_db(settings.DATABASE)
+    else:
+        utils.migrate(settings.DATABASE)
+    models.load_schemas(settings.DATABASE)
+    server_class = AsyncServer if args.engine == "async" else Server
+    if args.workers > 1:
+        server = Supervisor(server_class, (settings.HOST, settings.PORT), args.workers)
+    else:
+        server = server_class((settings.HOST, settings.PORT))
+    server.runserver()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,14 +6,42 @@ parser.read_file(codecs.open("config.ini", "r", "utf-8"))
 
 SECRET_KEY = parser.get("SECRET", "KEY")
 SALT = parser.get("SECRET", "SALT").encode()
+PREVIOUS_KEYS = [key.strip() for key in parser.get("SECRET", "PREVIOUS_KEYS", fallback="").split(",") if key.strip()]
 DEBUG = parser.get("GENERAL", "DEBUG")
+MAX_FRAME_SIZE = parser.getint("GENERAL", "MAX_FRAME_SIZE", fallback=32 * 2 ** 20)
+PIPELINE_WORKERS = parser.getint("GENERAL", "PIPELINE_WORKERS", fallback=16)
+PIPELINE_DEPTH = parser.getint("GENERAL", "PIPELINE_DEPTH", fallback=8)
+MAX_CONNECTIONS = parser.getint("GENERAL", "MAX_CONNECTIONS", fallback=1024)
+HANDSHAKE_TIMEOUT = parser.getfloat("GENERAL", "HANDSHAKE_TIMEOUT", fallback=10)
+IDLE_TIMEOUT = parser.getfloat("GENERAL", "IDLE_TIMEOUT", fallback=300)
+WRITE_TIMEOUT = parser.getfloat("GENERAL", "WRITE_TIMEOUT", fallback=30)
+
+CRYPTO_WORKERS = parser.getint("CRYPTO", "WORKERS", fallback=0)
+CRYPTO_QUEUE_SIZE = parser.getint("CRYPTO", "QUEUE_SIZE", fallback=64)
+CRYPTO_TIMEOUT = parser.getfloat("CRYPTO", "TIMEOUT", fallback=5)
+
+MAINTENANCE_INTERVAL = parser.getint("MAINTENANCE", "INTERVAL", fallback=3600)
+MAINTENANCE_BATCH_SIZE = parser.getint("MAINTENANCE", "BATCH_SIZE", fallback=1000)
+
+METRICS_HOST = parser.get("METRICS", "HOST", fallback="127.0.0.1")
+METRICS_PORT = parser.getint("METRICS", "PORT", fallback=0)
+ADMINS = [name.strip() for name in parser.get("METRICS", "ADMINS", fallback="").split(",") if name.strip()]
 
 
 EXPIRATION = {
     "minutes": 15
 }
+TOKEN_CACHE_SIZE = 100000
+TOKEN_CACHE_TTL = 60
+POST_CACHE_SIZE = 10000
+POST_CACHE_TTL = 5
+POST_CACHE_CHECK_INTERVAL = 0.1
+POST_CACHE_LISTING_ROWS = 1000
+SUBSCRIPTION_QUEUE_SIZE = 256
 DATABASE = "core/db/sqlite3.db"
 MEDIA_ROOT = "assets"
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 100
 PORT = 6666
 HOST = "0.0.0.0"
 CERTS_DIR = "backend/certs"
\ No newline at end of file
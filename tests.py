@@ -1,20 +1,38 @@
 import abc
+import asyncio
 import base64
+import datetime
+import hashlib
+import importlib.util
 import json
 import os
 import socket
 import sqlite3
 import ssl
+import sys
+import tempfile
 import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 import shutil
+import signal
 import settings
-from backend import crypto
-from backend.server import Server
-from core import models
+from cryptography.fernet import Fernet
+from backend import crypto, metrics
+from benchmarks.loadtest import generate_certificate
+from backend.hub import Subscription, hub
+from backend.maintenance import MaintenanceThread
+from backend.workers import Supervisor
+from backend import server
+from backend.server import Server, AsyncServer, AsyncClient, Client, ClientThread, FrameReader, FrameTooLargeError, \
+    create_ssl_context
+from core import codec, messages, models
 import utils
 from core.controllers import Controller
-from core.messages import Request, Response, ModelResponse
+from core.cache import post_cache
+from core.messages import Request, Response, ModelResponse, StreamingModelResponse, EncodedResponse
 
 
 class CryptographyTestCase(unittest.TestCase):
@@ -47,6 +65,91 @@ class CryptographyTestCase(unittest.TestCase):
         cipher = crypto.encrypt(self.plain)
         self.assertTrue(crypto.compare(self.plain, cipher))
 
+    def test_key_rotation(self):
+        old_cipher = Fernet(crypto.generate_key("old_secret_key")).encrypt(self.plain.encode()).decode()
+        previous_keys = settings.PREVIOUS_KEYS
+        settings.PREVIOUS_KEYS = ["old_secret_key"]
+        crypto.get_fernet.cache_clear()
+        try:
+            self.assertTrue(crypto.compare(self.plain, old_cipher))
+            rotated_cipher = crypto.rotate(old_cipher)
+        finally:
+            settings.PREVIOUS_KEYS = previous_keys
+            crypto.get_fernet.cache_clear()
+        self.assertTrue(crypto.compare(self.plain, rotated_cipher))
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+
+    def test_inline_pool(self):
+        pool = crypto.WorkerPool(workers=0)
+        self.assertEqual(pool.run(pow, 2, 10), 1024)
+
+    def test_process_pool(self):
+        pool = crypto.WorkerPool(workers=1, queue_size=0)
+        try:
+            cipher = pool.run(crypto.encrypt, "test123123")
+            self.assertTrue(pool.run(crypto.compare, "test123123", cipher))
+        finally:
+            pool.shutdown()
+
+    def test_saturated_pool(self):
+        pool = crypto.WorkerPool(workers=1, queue_size=0)
+        busy = threading.Thread(target=pool.run, args=(time.sleep, 1))
+        try:
+            busy.start()
+            time.sleep(0.2)
+            with self.assertRaises(crypto.PoolBusyError):
+                pool.run(pow, 2, 10)
+        finally:
+            busy.join()
+            pool.shutdown()
+
+    def test_workers_do_not_inherit_sockets(self):
+        pool = crypto.WorkerPool(workers=1, queue_size=0)
+        listener = socket.socket()
+        fd = os.dup2(listener.fileno(), 250)
+        try:
+            pool.start()
+            with self.assertRaises(OSError):
+                pool.run(os.fstat, fd)
+        finally:
+            os.close(fd)
+            listener.close()
+            pool.shutdown()
+
+    def test_broken_pool(self):
+        pool = crypto.WorkerPool(workers=1, queue_size=0)
+        try:
+            with self.assertRaises(crypto.PoolBusyError):
+                pool.run(os._exit, 1)
+            self.assertEqual(pool.run(pow, 2, 10), 1024)
+        finally:
+            pool.shutdown()
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def test_token_cache(self):
+        cache = utils.TokenCache(max_size=2, ttl=60)
+        cache.set("test.db", "token1", 1, time.time() + 60)
+        self.assertEqual(cache.get("test.db", "token1"), 1)
+        self.assertIsNone(cache.get("other.db", "token1"))
+        cache.invalidate("test.db", "token1")
+        self.assertIsNone(cache.get("test.db", "token1"))
+
+    def test_token_expiration(self):
+        cache = utils.TokenCache(max_size=2, ttl=60)
+        cache.set("test.db", "token1", 1, time.time() - 1)
+        self.assertIsNone(cache.get("test.db", "token1"))
+
+    def test_cache_size(self):
+        cache = utils.TokenCache(max_size=2, ttl=60)
+        for user_id in range(3):
+            cache.set("test.db", f"token{user_id}", user_id, time.time() + 60)
+        self.assertIsNone(cache.get("test.db", "token0"))
+        self.assertEqual(cache.get("test.db", "token2"), 2)
+
 
 class BaseControllerTest(unittest.TestCase, metaclass=abc.ABCMeta):
 
@@ -60,6 +163,7 @@ class BaseControllerTest(unittest.TestCase, metaclass=abc.ABCMeta):
         self.post_model = models.Post(self.db_name)
 
     def tearDown(self) -> None:
+        utils.connections.invalidate(self.db_name)
         os.remove(self.db_name)
 
 
@@ -93,6 +197,14 @@ class ModelTests(BaseControllerTest):
         with self.assertRaises(sqlite3.OperationalError):
             updated_user = self.user_model.update(data={}, where={"id": user[0]})
 
+    def test_post_update_returns_updated_row(self):
+        first = self.post_model.create(image="", content="first", title="same", user_id=1)
+        second = self.post_model.create(image="", content="second", title="other", user_id=1)
+        updated = self.post_model.update(data={"title": "same"}, where={"id": second[0]})
+        self.assertEqual(updated[0], second[0])
+        self.assertNotEqual(updated[0], first[0])
+        self.assertEqual(updated, self.post_model.first(id=second[0]))
+
     def test_select(self):
         self.assertListEqual(self.user_model.all(), [])
         user = self.user_model.create(**self.user_data)
@@ -103,6 +215,37 @@ class ModelTests(BaseControllerTest):
         with self.assertRaises(sqlite3.OperationalError):
             self.user_model.filter(x="d")
 
+    def test_iter_rows(self):
+        posts = [self.post_model.create(image="", content="", title=str(index), user_id=1) for index in range(5)]
+        self.assertEqual(list(self.post_model.iter_rows(2)), posts)
+        self.assertEqual(list(self.post_model.iter_rows(2, after_id=posts[1][0], fields=["title"])),
+                         [(post[0], post[3]) for post in posts[2:]])
+
+    def test_schema_cache(self):
+        schema = self.user_model.get_schema()
+        self.assertIs(schema, models.User(self.db_name).get_schema())
+        self.assertEqual(self.user_model.get_readable_cols(), ((0, 1), ("id", "username")))
+        models.Model.clear_schemas(self.db_name)
+        self.assertIsNot(schema, self.user_model.get_schema())
+
+    def test_transaction_rollback(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.user_model.transaction():
+                self.user_model.create(**self.user_data)
+                self.user_model.filter(x="d")
+        self.assertListEqual(self.user_model.all(), [])
+
+    def test_nested_transaction(self):
+        with self.user_model.transaction():
+            self.user_model.create(**self.user_data)
+            with self.assertRaises(sqlite3.OperationalError):
+                with self.post_model.transaction():
+                    self.post_model.create(image="", content="", title="", user_id=1)
+                    self.post_model.filter(x="d")
+        self.assertEqual(len(self.user_model.all()), 1)
+        self.assertListEqual(self.post_model.all(), [])
+        self.assertFalse(self.user_model.conn.in_transaction)
+
     def test_auth_token_creation(self):
         user = self.user_model.create(**self.user_data)
         auth_token = self.auth_token_model.create(user_id=user[0])
@@ -114,6 +257,114 @@ class ModelTests(BaseControllerTest):
             is_valid = self.auth_token_model.is_valid(user_id=123123123)
 
 
+class ConnectionPoolTests(BaseControllerTest):
+
+    def test_connection_reuse(self):
+        pool = utils.ConnectionPool()
+        conn = pool.get(self.db_name)
+        hits = metrics.db_connections_total.snapshot().get("hit", 0)
+        self.assertIs(conn, pool.get(self.db_name))
+        self.assertEqual(pool.stats(), {"hits": 1, "misses": 1, "open": 1})
+        self.assertEqual(metrics.db_connections_total.snapshot()["hit"], hits + 1)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        pool.release()
+
+    def test_connection_per_thread(self):
+        pool = utils.ConnectionPool()
+        conn = pool.get(self.db_name)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(pool.get(self.db_name)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(conn, other[0])
+        self.assertEqual(pool.stats()["open"], 2)
+        pool.invalidate(self.db_name)
+        self.assertEqual(pool.stats()["open"], 0)
+        self.assertIsNot(conn, pool.get(self.db_name))
+        pool.invalidate(self.db_name)
+
+    def test_models_share_connection(self):
+        self.assertIs(self.user_model.conn, self.post_model.conn)
+
+
+class MaintenanceTests(BaseControllerTest):
+
+    def test_expired_tokens_sweep(self):
+        expired = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        for user_id in range(5):
+            token = self.auth_token_model.create(user_id=user_id)
+            if user_id < 3:
+                self.auth_token_model.update(data={"expires": expired}, where={"id": token[0]})
+        maintenance = MaintenanceThread(self.db_name, batch_size=2)
+        self.assertEqual(maintenance.sweep(), 3)
+        self.assertEqual(len(self.auth_token_model.all()), 2)
+        self.assertEqual(maintenance.sweep(), 0)
+
+
+class MigrationTests(BaseControllerTest):
+
+    def get_indexes(self):
+        conn = utils.create_conn(self.db_name)
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        conn.close()
+        return indexes
+
+    def test_migrate_existing_db(self):
+        conn = utils.create_conn(self.db_name)
+        with open("core/db/create_db.sql", "r") as script:
+            conn.executescript(script.read())
+        conn.execute("PRAGMA user_version = 0")
+        conn.execute("INSERT INTO user(username, password) VALUES ('test_username', 'test_pass')")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(utils.migrate(self.db_name), [version for version, _ in utils.get_migrations()])
+        self.assertIn("user_username_uindex", self.get_indexes())
+        self.assertEqual(len(self.user_model.all()), 1)
+        self.assertEqual(utils.migrate(self.db_name), [])
+
+    def test_migrate_duplicate_usernames(self):
+        conn = utils.create_conn(self.db_name)
+        with open("core/db/create_db.sql", "r") as script:
+            conn.executescript(script.read())
+        conn.execute("PRAGMA user_version = 0")
+        for username in ("taken", "taken", "other", "taken"):
+            conn.execute("INSERT INTO user(username, password) VALUES (?, 'test_pass')", (username,))
+        conn.commit()
+        conn.close()
+
+        utils.migrate(self.db_name)
+        self.assertEqual([user[:2] for user in self.user_model.all()],
+                         [(1, "taken"), (2, "taken#2"), (3, "other"), (4, "taken#4")])
+        self.assertIn("user_username_uindex", self.get_indexes())
+
+    def test_enable_incremental_vacuum(self):
+        conn = utils.create_conn(self.db_name)
+        conn.execute("PRAGMA auto_vacuum = none")
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA journal_mode=WAL")
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+        conn.close()
+
+        utils.migrate(self.db_name)
+        conn = utils.create_conn(self.db_name)
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        self.assertFalse(utils.enable_incremental_vacuum(conn))
+        conn.close()
+
+    def test_failed_migration(self):
+        migrations_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(migrations_dir, "0099_broken.sql"), "w") as script:
+                script.write("create index post_title_index on post (title);\ncreate index broken on nonexisting (id);")
+            with self.assertRaises(sqlite3.OperationalError):
+                utils.migrate(self.db_name, migrations_dir)
+        finally:
+            shutil.rmtree(migrations_dir)
+        self.assertNotIn("post_title_index", self.get_indexes())
+        self.assertEqual(utils.migrate(self.db_name), [])
+
+
 class MessageTests(BaseControllerTest):
 
     def setUp(self) -> None:
@@ -131,25 +382,54 @@ class MessageTests(BaseControllerTest):
 
     def test_getting_action(self):
         self.message.obj["action"] = "nonexistingactionfortests"
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(utils.ProtonError):
             self.message.get_action()
 
     def test_required_params(self):
         # delete required parameter "username"
         del self.message.obj["params"]["username"]
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(utils.ProtonError):
             self.message.get_params()
 
     def test_empty_params(self):
         # remove params from message object
         del self.message.obj["params"]
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(utils.ProtonError):
             self.message.get_params()
 
-        # remove params from required_params field of message
-        self.message.required_action_params[self.message.action] = None
+        # actions without required params accept a missing params field
+        self.message.action = "logout"
         self.assertIsNone(self.message.get_params())
 
+    def test_bytes_request(self):
+        request = Request(self.proper_request.encode())
+        self.assertEqual(request.params["username"], "...")
+        with self.assertRaises(utils.ProtonError):
+            Request(b'{"action": "logout", "params": "\xff"}')
+
+    def test_codec_without_orjson(self):
+        spec = importlib.util.spec_from_file_location("fallback_codec", codec.__file__)
+        fallback = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(sys.modules, {"orjson": None}):
+            spec.loader.exec_module(fallback)
+        self.assertEqual(fallback.name, "json")
+        # both codecs refuse lone surrogates, whether escaped or raw
+        for raw in (b'{"action": "logout", "id": "\\ud800"}', '{"action": "logout", "id": "\ud800"}'):
+            with self.assertRaises(codec.DecodeError):
+                fallback.loads(raw)
+            with self.assertRaises(codec.DecodeError):
+                codec.loads(raw)
+        self.assertEqual(fallback.loads(b'{"a": "\\ud83d\\ude00"}'), {"a": "\U0001f600"})
+        obj = {"title": "zażółć \U0001f600", "values": [1, 2.5, None, True]}
+        self.assertEqual(fallback.dumps(obj), codec.dumps(obj))
+        with mock.patch.object(messages, "codec", fallback):
+            response = Client(self.db_name).handle(b'{"action": "logout", "id": "\\ud800"}')
+        self.assertEqual(response.message, "Syntax Error")
+
+    def test_compact_response(self):
+        response = Response("OK", data=[{"title": "zażółć"}], action="get")
+        self.assertEqual(list(response.iter_chunks()), ['{"status":"OK","data":[{"title":"zażółć"}]}\r\n'.encode()])
+
 
 class ControllerTests(BaseControllerTest):
     media_root = "test_assets"
@@ -164,7 +444,7 @@ class ControllerTests(BaseControllerTest):
 
     def setUp(self) -> None:
         super(ControllerTests, self).setUp()
-        self.controller = Controller(None, self.db_name)
+        self.controller = Controller(None, self.db_name, self.media_root)
 
     def get_token(self, token_instance):
         token_id = token_instance.data[0]["id"]
@@ -199,6 +479,14 @@ class ControllerTests(BaseControllerTest):
         self.assertEqual(request["params"]["username"], result.data[0]["username"])
         self.assertNotEqual(request["params"]["password"], result.data[0]["username"])
 
+    def test_concurrent_register(self):
+        self._request_action(self.requests[0])
+        # the other registration wins the race after the existence check
+        self.controller.user_model.filter = lambda **kwargs: []
+        result = self._request_action(self.requests[0])
+        self.assertEqual(result.status, "ERROR")
+        self.assertEqual(result.message, "Given user already exists.")
+
     def test_getting_token(self):
         user = self._request_action(self.requests[0])
 
@@ -223,6 +511,17 @@ class ControllerTests(BaseControllerTest):
         result = self._request_action(request)
         self.assertEqual(result.status, "ERROR")
 
+    def test_cached_auth(self):
+        self._create_post()
+        request = self._login(self.requests[5], False)
+        statements = []
+        self.post_model.conn.set_trace_callback(statements.append)
+        try:
+            self._request_action(request)
+        finally:
+            self.post_model.conn.set_trace_callback(None)
+        self.assertFalse([sql for sql in statements if "authtoken" in sql])
+
     def test_proper_logout(self):
         user = self._request_action(self.requests[0])
         token = self._request_action(self.requests[1])
@@ -239,13 +538,32 @@ class ControllerTests(BaseControllerTest):
 
     def _create_post(self, create_user=True):
         request = self._login(self.requests[3], create_user)
-        request["params"]["image"] = self.image_str
+        request["params"]["image"] = utils.get_image_base64(self.image_str)
         response = self._request_action(request)
         return response
 
     def test_create_full_data_post(self):
         response = self._create_post()
-        self.assertTrue(response.status)
+        self.assertEqual(response.status, "OK")
+        self.assertTrue(os.path.isfile(os.path.join(self.media_root, response.data[0]["image"])))
+
+    def test_create_invalid_image(self):
+        request = self._login(self.requests[3])
+        request["params"]["image"] = "definitely not base64"
+        response = self._request_action(request)
+        self.assertEqual(response.status, "ERROR")
+
+    def test_getting_media(self):
+        post = self._create_post()
+        request = self._login({"action": "media", "params": {"id": post.data[0]["image"]}}, False)
+        response = self._request_action(request)
+        self.assertEqual(response.data["image"], utils.get_image_base64(self.image_str))
+        self.assertEqual(json.loads(response.json_response)["data"], response.data)
+
+        request["params"]["id"] = "0" * 64
+        self.assertEqual(self._request_action(request).status, "WRONG")
+        request["params"]["id"] = "../corgi.jpeg"
+        self.assertEqual(self._request_action(request).status, "ERROR")
 
     def test_getting_post_by_id(self):
         self._create_post()
@@ -259,14 +577,145 @@ class ControllerTests(BaseControllerTest):
         self._create_post(False)
         request = self._login(self.requests[4], False)
         response = self._request_action(request)
-        self.assertIsInstance(response, ModelResponse)
+        self.assertEqual(response.status, "OK")
+        self.assertEqual(len(response.data), 2)
+
+    def test_getting_post_page(self):
+        self._create_post(True)
+        for _ in range(2):
+            self._create_post(False)
+        request = self._login({"action": "get", "params": {"limit": 2, "fields": ["title"]}}, False)
+        response = self._request_action(request)
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(set(response.data[0]), {"id", "title"})
+        self.assertEqual(response.next_cursor, response.data[-1]["id"])
+
+        request["params"]["after_id"] = response.next_cursor
+        response = self._request_action(request)
+        self.assertEqual(len(response.data), 1)
+        self.assertIsNone(response.next_cursor)
+
+        request["params"]["fields"] = ["nonexistingfield"]
+        response = self._request_action(request)
+        self.assertEqual(response.status, "ERROR")
+
+    def test_invalid_page_cursor(self):
+        self._create_post(True)
+        for after_id in ({}, [1], "1", True, 1.5):
+            request = self._login({"action": "get", "params": {"after_id": after_id}}, False)
+            response = self._request_action(request)
+            self.assertEqual(response.status, "ERROR", after_id)
+            self.assertEqual(response.message, "after_id must be an integer.")
+
+    def test_streaming_posts(self):
+        self._create_post(True)
+        self._create_post(False)
+        request = self._login(self.requests[4], False)
+        listing_rows = settings.POST_CACHE_LISTING_ROWS
+        # listings longer than the cached ones are streamed
+        settings.POST_CACHE_LISTING_ROWS = 1
+        try:
+            response = self._request_action(request)
+        finally:
+            settings.POST_CACHE_LISTING_ROWS = listing_rows
+        self.assertIsInstance(response, StreamingModelResponse)
+        expected = ModelResponse("OK", self.post_model, self.post_model.all(), action="get")
+        self.assertEqual(b"".join(response.iter_chunks()), expected.json_response.encode())
+
+    def test_cached_posts(self):
+        self._create_post(True)
+        self._create_post(False)
+        request = self._login(self.requests[4], False)
+        expected = ModelResponse("OK", self.post_model, self.post_model.all(), action="get")
+        post_cache.clear()
+        first = self._request_action(request)
+        second = self._request_action(request)
+        self.assertIsInstance(second, EncodedResponse)
+        self.assertEqual(first.json_response, expected.json_response)
+        self.assertEqual(second.json_response, expected.json_response)
+        # the listing also filled the records
+        response = self._request_action({"action": "get", "params": {"id": 2}})
+        self.assertIsInstance(response, EncodedResponse)
+        self.assertEqual(response.data, expected.data[1:])
+        self.assertEqual(post_cache.stats()["hits"], 2)
+
+        self._request_action({"action": "alter", "params": {"id": "2", "title": "altered"}})
+        self.assertEqual(self._request_action({"action": "get", "params": {"id": 2}}).data[0]["title"], "altered")
+        self._request_action({"action": "delete", "params": {"id": 1}})
+        self.assertEqual(self._request_action({"action": "get", "params": {"id": 1}}).status, "WRONG")
+        self._create_post(False)
+        self.assertEqual([post["id"] for post in self._request_action(request).data], [2, 3])
+
+        # another server process writes through its own connection, without touching this cache
+        check_interval = post_cache.check_interval
+        post_cache.check_interval = 0
+        try:
+            # the writes above bumped the post version too, the first check drops the cache once more
+            self._request_action({"action": "get", "params": {"id": 2}})
+            self.assertIsInstance(self._request_action({"action": "get", "params": {"id": 2}}), EncodedResponse)
+            # logins and registrations elsewhere do not touch posts, they keep the cached ones
+            self._login(self.requests[4], False)
+            with sqlite3.connect(self.db_name) as other:
+                other.execute("INSERT INTO user (username, password) VALUES ('elsewhere', '')")
+            self.assertIsInstance(self._request_action({"action": "get", "params": {"id": 2}}), EncodedResponse)
+            with sqlite3.connect(self.db_name) as other:
+                other.execute("UPDATE post SET title = 'elsewhere' WHERE id = 2")
+            response = self._request_action({"action": "get", "params": {"id": 2}})
+        finally:
+            post_cache.check_interval = check_interval
+        self.assertEqual(response.data[0]["title"], "elsewhere")
+
+    def test_batch(self):
+        image = utils.get_image_base64(self.image_str)
+        operations = [{"action": "create", "id": number, "params": {"title": f"title {number}", "content": "...",
+                                                                     "image": image}} for number in range(3)]
+        operations.append({"action": "get", "params": {"fields": ["title"]}})
+        request = self._login({"action": "batch", "params": operations})
+        response = self._request_action(request)
+        self.assertEqual(response.status, "OK")
+        self.assertEqual([result["id"] for result in response.data[:3]], [0, 1, 2])
+        self.assertEqual(len(response.data[3]["data"]), 3)
+
+    def test_failed_batch(self):
+        operations = [{"action": "create", "params": {"title": "title", "content": "..."}},
+                      {"action": "create", "params": {"title": "title", "content": "...", "image": "not base64"}}]
+        request = self._login({"action": "batch", "params": operations})
+        response = self._request_action(request)
+        self.assertEqual(response.status, "ERROR")
         self.assertEqual(len(response.data), 2)
+        self.assertListEqual(self.post_model.all(), [])
+
+        # images of a rolled back batch are removed again
+        image = os.urandom(64)
+        operations[0]["params"]["image"] = base64.b64encode(image).decode()
+        request["params"] = operations
+        self.assertEqual(self._request_action(request).status, "ERROR")
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, hashlib.sha256(image).hexdigest())))
+
+        request["params"] = [{"action": "logout"}]
+        self.assertEqual(self._request_action(request).status, "ERROR")
+        request["params"] = ["create"]
+        self.assertEqual(self._request_action(request).status, "ERROR")
+
+    def test_stats(self):
+        request = self._login({"action": "stats"})
+        self.assertEqual(self._request_action(request).status, "ERROR")
+        admins = settings.ADMINS
+        settings.ADMINS = [self.requests[0]["params"]["username"]]
+        try:
+            response = self._request_action(request)
+        finally:
+            settings.ADMINS = admins
+        self.assertEqual(response.status, "OK")
+        self.assertIn("proton_db_query_duration_seconds", response.data)
+        json.loads(response.json_response)
 
     def test_post_modify(self):
         post = self._create_post()
         request = self.requests[6]
         title = "NEWTITLE"
         request["params"]["title"] = title
+        request["params"]["image"] = utils.get_image_base64(self.image_str)
         request = self._login(request, False)
         response = self._request_action(request)
         self.assertIsInstance(response, ModelResponse)
@@ -281,6 +730,461 @@ class ControllerTests(BaseControllerTest):
         self.assertListEqual(self.post_model.all(), [])
 
 
+class LoggerTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.log_dir)
+
+    def test_batched_write(self):
+        logger = utils.Logger(self.log_dir)
+        for number in range(100):
+            logger.info(f"message {number} 100%")
+        logger.flush()
+        with open(logger.get_log_filename(), "r") as file:
+            lines = file.read().splitlines()
+        self.assertEqual(len(lines), 100)
+        self.assertTrue(lines[-1].endswith("message 99 100%"))
+
+    def test_full_queue(self):
+        logger = utils.Logger(self.log_dir, max_queue_size=2)
+        disk = threading.Event()
+        write_batch = logger.write_batch
+        logger.write_batch = lambda logs: (disk.wait(), write_batch(logs))
+        for number in range(10):
+            logger.info(f"message {number}")
+        disk.set()
+        logger.flush()
+        with open(logger.get_log_filename(), "r") as file:
+            lines = file.read().splitlines()
+        messages = [line for line in lines if "message" in line]
+        self.assertGreater(logger.dropped, 0)
+        self.assertEqual(len(messages) + logger.dropped, 10)
+        reported = [int(line.split("dropped ")[1].split()[0]) for line in lines if "queue full" in line]
+        self.assertEqual(sum(reported), logger.dropped)
+
+    def test_rotation(self):
+        logger = utils.Logger(self.log_dir, max_log_dir_size=3000, backup_count=2)
+        for number in range(100):
+            logger.info(f"message {number}")
+        logger.flush()
+        self.assertEqual(sorted(os.listdir(self.log_dir)), ["proton_std.log", "proton_std.log.1", "proton_std.log.2"])
+        for filename in os.listdir(self.log_dir):
+            self.assertLessEqual(os.stat(os.path.join(self.log_dir, filename)).st_size, 1000)
+        with open(logger.get_log_filename(), "r") as file:
+            self.assertTrue(file.read().splitlines()[-1].endswith("message 99"))
+
+
+class ClientTests(BaseControllerTest):
+
+    def test_invalid_request(self):
+        response = Client(self.db_name).handle("""{"action": "nonexistingactionfortests"}""")
+        self.assertEqual(response.status, "ERROR")
+        self.assertEqual(response.message, "Syntax Error")
+
+    def test_request_id(self):
+        response = Client(self.db_name).handle("""{"action": "logout", "id": 12}""")
+        self.assertEqual(json.loads(response.json_response)["id"], 12)
+        response = Client(self.db_name).handle("""{"action": "nonexistingactionfortests", "id": "a1"}""")
+        self.assertEqual(json.loads(response.json_response)["id"], "a1")
+        response = Client(self.db_name).handle("""{"action": "logout"}""")
+        self.assertNotIn("id", json.loads(response.json_response))
+
+    def test_concurrent_actions(self):
+        client = Client(self.db_name)
+        self.assertTrue(client.is_concurrent(Request("""{"action": "get", "id": 1}""")))
+        self.assertFalse(client.is_concurrent(Request("""{"action": "get"}""")))
+        self.assertFalse(client.is_concurrent(Request("""{"action": "logout", "id": 2}""")))
+
+    def test_saturated_pipeline(self):
+        taken = 0
+        while server.pipeline_slots.acquire(blocking=False):
+            taken += 1
+        self.addCleanup(lambda: [server.pipeline_slots.release() for _ in range(taken)])
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            sock = socket.create_connection(listener.getsockname())
+            conn, _ = listener.accept()
+        ClientThread(conn, self.db_name).start()
+        with sock:
+            # every pipeline worker is busy, the connection answers the request itself
+            sock.settimeout(3)
+            sock.sendall(b'{"action": "get", "id": 1}\r\n')
+            response = json.loads(sock.makefile("rb").readline())
+        self.assertEqual(response["id"], 1)
+
+    def test_permission_denied(self):
+        response = Client(self.db_name).handle("""{"action": "logout"}""")
+        self.assertEqual(response.status, "ERROR")
+        self.assertIn("Permission denied", response.message)
+
+
+class FrameReaderTests(unittest.TestCase):
+
+    def test_split_frame(self):
+        frames = FrameReader()
+        frames.feed(b'{"action": "get"}\r')
+        self.assertIsNone(frames.next_frame())
+        frames.feed(b"\n")
+        self.assertEqual(frames.next_frame(), b'{"action": "get"}')
+        self.assertIsNone(frames.next_frame())
+
+    def test_pipelined_frames(self):
+        frames = FrameReader()
+        frames.feed(b'{"action": "get"}\r\n{"action": "logout"}\r\n{"act')
+        self.assertEqual(frames.next_frame(), b'{"action": "get"}')
+        self.assertEqual(frames.next_frame(), b'{"action": "logout"}')
+        self.assertIsNone(frames.next_frame())
+        frames.feed(b'ion": "get"}\r\n')
+        self.assertEqual(frames.next_frame(), b'{"action": "get"}')
+
+    def test_max_frame_size(self):
+        frames = FrameReader(max_frame_size=8)
+        frames.feed(b"0123456789")
+        with self.assertRaises(FrameTooLargeError):
+            frames.next_frame()
+
+
+class ServerTests(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT is not supported")
+    def test_reuse_port(self):
+        first = Server(("127.0.0.1", 0), reuse_port=True).get_raw_socket()
+        port = first.getsockname()[1]
+        second = Server(("127.0.0.1", port), reuse_port=True).get_raw_socket()
+        self.assertEqual(second.getsockname()[1], port)
+        first.close()
+        second.close()
+
+    def test_ssl_context_is_shared(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server = Server(("127.0.0.1", 0), ssl_context=context)
+        self.assertIs(server.get_ssl_context(), context)
+        self.assertIs(server.get_ssl_context(), server.get_ssl_context())
+
+
+class ConnectionLimitTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.certs_dir = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.certs_dir, "server.pem")
+        cls.keyfile = os.path.join(cls.certs_dir, "server.key")
+        generate_certificate(cls.certfile, cls.keyfile)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls.certs_dir)
+
+    def setUp(self) -> None:
+        self.previous = (settings.MAX_CONNECTIONS, settings.HANDSHAKE_TIMEOUT, settings.IDLE_TIMEOUT)
+        settings.MAX_CONNECTIONS, settings.HANDSHAKE_TIMEOUT, settings.IDLE_TIMEOUT = 1, 0.5, 0.5
+
+    def tearDown(self) -> None:
+        settings.MAX_CONNECTIONS, settings.HANDSHAKE_TIMEOUT, settings.IDLE_TIMEOUT = self.previous
+
+    def start_server(self, server_class=Server) -> tuple:
+        server = server_class(("127.0.0.1", 0), maintenance=False,
+                              ssl_context=create_ssl_context(self.certfile, self.keyfile))
+        if server_class is AsyncServer:
+            loop = asyncio.new_event_loop()
+            listener = loop.run_until_complete(server.start())
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+            self.addCleanup(loop.call_soon_threadsafe, listener.close)
+            return server, listener.sockets[0].getsockname()
+        server_socket = server.get_raw_socket()
+        threading.Thread(target=server.process, args=(server_socket,), daemon=True).start()
+        self.addCleanup(server_socket.close)
+        return server, server_socket.getsockname()
+
+    def assertClosed(self, sock: socket.socket, within: float) -> None:
+        sock.settimeout(within)
+        try:
+            self.assertEqual(sock.recv(1), b"")
+        except ConnectionResetError:
+            pass
+
+    def assertServed(self, address: tuple) -> None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        with context.wrap_socket(socket.create_connection(address, timeout=3)) as sock:
+            sock.sendall(b'{"action": "logout"}\r\n')
+            self.assertIn(b"Permission denied", sock.makefile("rb").readline())
+
+    def test_handshake_timeout(self):
+        settings.MAX_CONNECTIONS = 2
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class.__name__):
+                failed = metrics.handshakes_total.snapshot().get("failed", 0)
+                server, address = self.start_server(server_class)
+                with socket.create_connection(address) as silent:
+                    # other clients are served while the silent one holds its handshake
+                    self.assertServed(address)
+                    self.assertClosed(silent, within=3)
+                # the async engine records the failure just after it has dropped the connection
+                deadline = time.monotonic() + 1
+                while metrics.handshakes_total.snapshot().get("failed", 0) == failed and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(metrics.handshakes_total.snapshot()["failed"], failed + 1)
+
+    def test_session_resumption(self):
+        settings.MAX_CONNECTIONS = 2
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class.__name__):
+                server, address = self.start_server(server_class)
+                resumed = metrics.handshakes_total.snapshot().get("resumed", 0)
+                session = None
+                for reused in (False, True):
+                    with context.wrap_socket(socket.create_connection(address, timeout=3), session=session) as sock:
+                        self.assertEqual(sock.session_reused, reused)
+                        # TLS 1.3 tickets arrive after the handshake, a response is read before taking the session
+                        sock.sendall(b'{"action": "logout"}\r\n')
+                        sock.makefile("rb").readline()
+                        session = sock.session
+                self.assertEqual(metrics.handshakes_total.snapshot()["resumed"], resumed + 1)
+
+    def test_connection_cap(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class.__name__):
+                server, address = self.start_server(server_class)
+                with socket.create_connection(address) as first:
+                    time.sleep(0.1)
+                    # refused before its handshake, well within HANDSHAKE_TIMEOUT
+                    with socket.create_connection(address) as second:
+                        self.assertClosed(second, within=0.4)
+                    self.assertClosed(first, within=3)
+
+    def test_idle_timeout(self):
+        server, address = self.start_server()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        with context.wrap_socket(socket.create_connection(address)) as idle:
+            self.assertClosed(idle, within=3)
+        # the slot is given back once the idle client is gone
+        time.sleep(0.1)
+        self.assertTrue(server.connections.acquire(blocking=False))
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ("action",), buckets=(0.1, 1))
+        for value in (0.05, 0.05, 0.5, 5):
+            histogram.observe(value, "get")
+        snapshot = histogram.snapshot()["get"]
+        self.assertEqual(snapshot["count"], 4)
+        self.assertEqual(snapshot["p50"], 0.1)
+        self.assertIsNone(snapshot["p99"])
+        self.assertIn('test_seconds_bucket{action="get",le="1"} 3', histogram.render())
+        self.assertIn('test_seconds_bucket{action="get",le="+Inf"} 4', histogram.render())
+
+    def test_client_records_requests(self):
+        before = metrics.requests_total.snapshot().get("get/ERROR", 0)
+        Client(":memory:").handle('{"action": "get"}')
+        self.assertEqual(metrics.requests_total.snapshot()["get/ERROR"], before + 1)
+
+    def test_metrics_server(self):
+        http_server = metrics.start_metrics_server(("127.0.0.1", 0))
+        self.addCleanup(http_server.shutdown)
+        with socket.create_connection(http_server.server_address) as sock:
+            sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = b""
+            while chunk := sock.recv(65536):
+                response += chunk
+        self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+        self.assertIn(b"# TYPE proton_active_connections gauge", response)
+
+
+class HubTests(BaseControllerTest):
+
+    def test_coalescing(self):
+        woken = []
+        subscription = Subscription("db", woken.append, max_pending=10)
+        subscription.push({"op": "create", "id": 1, "title": "a"})
+        subscription.push({"op": "alter", "id": 1, "title": "b"})
+        subscription.push({"op": "alter", "id": 2, "title": "c"})
+        subscription.push({"op": "delete", "id": 2})
+        subscription.push({"op": "create", "id": 3, "title": "d"})
+        subscription.push({"op": "delete", "id": 3})
+        self.assertEqual(len(woken), 1)
+        notification = subscription.drain()
+        self.assertEqual(notification.data, [{"op": "create", "id": 1, "title": "b"}, {"op": "delete", "id": 2}])
+        self.assertIsNone(subscription.drain())
+        subscription.push({"op": "delete", "id": 1})
+        self.assertEqual(len(woken), 2)
+
+    def test_overflow(self):
+        subscription = Subscription("db", lambda subscription: None, max_pending=2)
+        for post_id in range(3):
+            subscription.push({"op": "create", "id": post_id, "title": ""})
+        subscription.push({"op": "create", "id": 3, "title": ""})
+        self.assertEqual(subscription.drain().json_response, '{"event":"resync"}\r\n')
+        self.assertEqual(subscription.drain().data, [{"op": "create", "id": 3, "title": ""}])
+
+    def test_subscribe(self):
+        client = Client(self.db_name)
+        for request in self.requests[:2]:
+            client.handle(json.dumps(request))
+        self.assertEqual(client.handle('{"action": "subscribe"}').status, "OK")
+        self.addCleanup(client.unsubscribe)
+        request = dict(self.requests[3], params={"title": "title", "content": "content"})
+        client.handle(json.dumps(request))
+        client.handle(json.dumps({"action": "batch", "params": [request, {"action": "create", "params": {}}]}))
+        self.assertEqual(client.subscription.drain().data, [{"op": "create", "id": 1, "title": "title"}])
+        self.assertIsNone(client.subscription.drain())
+        client.handle('{"action": "unsubscribe"}')
+        self.assertIsNone(client.subscription)
+
+
+class StalledSocket(object):
+    """A peer that stopped reading: every write times out."""
+
+    def __init__(self):
+        self.shut_down = False
+
+    def sendall(self, data):
+        raise socket.timeout("timed out")
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+
+class StalledWriter(object):
+    def __init__(self):
+        self.transport = mock.Mock()
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 50000)
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        await asyncio.sleep(60)
+
+
+class PusherTests(BaseControllerTest):
+    event = {"op": "create", "id": 1, "title": "title"}
+
+    def test_stalled_thread_subscriber(self):
+        sock = StalledSocket()
+        client = ClientThread(sock, self.db_name)
+        client.subscribe()
+        self.addCleanup(client.unsubscribe)
+        hub.publish(self.db_name, self.event)
+        client.pusher.join(timeout=3)
+        self.assertFalse(client.pusher.is_alive())
+        self.assertIsNone(client.subscription)
+        self.assertTrue(sock.shut_down)
+
+    def test_stalled_async_subscriber(self):
+        writer = StalledWriter()
+
+        async def run_pusher():
+            client = AsyncClient(None, writer, self.db_name)
+            client.loop = asyncio.get_running_loop()
+            client.subscribe()
+            await asyncio.sleep(0)
+            hub.publish(self.db_name, self.event)
+            await asyncio.wait_for(client.pusher, 3)
+            return client
+
+        write_timeout = settings.WRITE_TIMEOUT
+        settings.WRITE_TIMEOUT = 0.1
+        try:
+            client = asyncio.run(run_pusher())
+        finally:
+            settings.WRITE_TIMEOUT = write_timeout
+        self.assertIsNone(client.subscription)
+        writer.transport.abort.assert_called_once()
+
+    def test_stalled_async_stream(self):
+        async def stream_to_stalled_readers():
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+            tasks = []
+            for _ in range(2):
+                client = AsyncClient(None, StalledWriter(), self.db_name)
+                client.loop = loop
+                response = EncodedResponse("OK", b"[" + b"0," * 2 ** 18 + b"0]", action="get")
+                client.handle_request = lambda request, response=response: response
+                tasks.append(loop.create_task(client.process(None)))
+            await asyncio.sleep(0.1)
+            # neither reader takes its response, the only executor thread must still serve other requests
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(None, int, "42"), 1)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        self.assertEqual(asyncio.run(stream_to_stalled_readers()), 42)
+
+
+class CrashingServer(Server):
+    """A worker that dies right after its start, as with a broken deployment."""
+
+    def get_ssl_context(self):
+        return ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+
+    def runserver(self):
+        raise SystemExit(3)
+
+
+class MissingCertServer(Server):
+    def get_ssl_context(self):
+        return create_ssl_context("/nonexistent/server.pem", "/nonexistent/server.key")
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT is not supported")
+class SupervisorTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.getsignal(signal.SIGTERM))
+        self.addCleanup(setattr, settings, "MAINTENANCE_INTERVAL", settings.MAINTENANCE_INTERVAL)
+        settings.MAINTENANCE_INTERVAL = 0
+
+    def test_failed_starts(self):
+        supervisor = Supervisor(CrashingServer, ("127.0.0.1", 0), workers=1)
+        supervisor.backoff, supervisor.max_failures = 0.2, 3
+        start = time.monotonic()
+        with mock.patch.object(supervisor, "spawn", wraps=supervisor.spawn) as spawn:
+            with self.assertRaises(utils.ProtonError):
+                supervisor.runserver()
+        # restarted after 0.2s and 0.4s, then given up on
+        self.assertEqual(spawn.call_count, 3)
+        self.assertGreaterEqual(time.monotonic() - start, 0.6)
+
+    def test_restart(self):
+        supervisor = Supervisor(CrashingServer, ("127.0.0.1", 0), workers=1)
+        # every worker counts as healthy, so it is restarted at once and never given up on
+        supervisor.min_uptime, supervisor.max_failures = 0, 1
+        spawn = supervisor.spawn
+
+        def spawn_three_times(index):
+            if spawn_mock.call_count == 3:
+                supervisor.stop()
+            return spawn(index)
+
+        with mock.patch.object(supervisor, "spawn", side_effect=spawn_three_times) as spawn_mock:
+            supervisor.runserver()
+        self.assertEqual(spawn_mock.call_count, 3)
+        self.assertEqual(supervisor.failures, [0])
+
+    def test_missing_certificate(self):
+        supervisor = Supervisor(MissingCertServer, ("127.0.0.1", 0), workers=2)
+        with mock.patch.object(supervisor, "spawn") as spawn:
+            with self.assertRaises(OSError):
+                supervisor.runserver()
+        spawn.assert_not_called()
+
+
 class ThreadedServer(threading.Thread):
     def run(self) -> None:
         server = Server(("localhost", 1234))
@@ -1,13 +1,22 @@
+import atexit
 import base64
+import collections
+import functools
 import os
+import queue
+import re
 import secrets
 import sqlite3
 import ssl
 import string
+import sys
+import threading
+import time
 from datetime import datetime
 
 import settings
-from core import models, messages
+from backend import metrics
+from core import cache, models, messages
 
 
 class ProtonError(Exception):
@@ -21,21 +30,73 @@ def generate_token(length=40):
 
 
 def validate_auth(fn):
+    @functools.wraps(fn)
     def wrapper(*args, **kwargs):
         controller, message = args
-        try:
-            token = controller.auth_token
-            assert controller.auth_token is not None
-            token_model = models.AuthToken(controller.db_name)
-            assert token_model.is_valid(token=token)
-        except (KeyError, AssertionError, ProtonError):
-            raise PermissionError("Permission denied. Authorization required.")
-        else:
-            return fn(*args, **kwargs)
+        token = controller.auth_token
+        user_id = token_cache.get(controller.db_name, token) if token is not None else None
+        if user_id is None:
+            try:
+                assert token is not None
+                token_model = models.AuthToken(controller.db_name)
+                instance = token_model.first(token=token)
+                assert instance is not None
+                expires = token_model.get_timestamp(instance[3])
+                assert time.time() < expires
+            except (KeyError, AssertionError, ProtonError):
+                raise PermissionError("Permission denied. Authorization required.")
+            user_id = instance[1]
+            token_cache.set(controller.db_name, token, user_id, expires)
+        controller.user_id = user_id
+        return fn(*args, **kwargs)
 
     return wrapper
 
 
+class TokenCache(object):
+    """Maps auth tokens to user ids, so authenticated requests do not have to query the database."""
+
+    def __init__(self, max_size=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        # entries are dropped after ttl seconds even if the token is still valid, which bounds how long
+        # a logout performed by another server process goes unnoticed
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, db_name, token):
+        key = (db_name, token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user_id, valid_until = entry
+            if time.time() >= valid_until:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user_id
+
+    def set(self, db_name, token, user_id, expires):
+        key = (db_name, token)
+        with self.lock:
+            self.entries[key] = (user_id, min(expires, time.time() + self.ttl))
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, db_name, token):
+        with self.lock:
+            self.entries.pop((db_name, token), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+token_cache = TokenCache()
+
+
 def create_conn(db_name=settings.DATABASE):
     try:
         conn = sqlite3.connect(db_name)
@@ -45,10 +106,133 @@ def create_conn(db_name=settings.DATABASE):
 
 
 def create_db(db_name=settings.DATABASE):
+    connections.invalidate(db_name)
+    models.Model.clear_schemas(db_name)
+    cache.post_cache.invalidate_all(db_name)
     conn = create_conn(db_name)
     cursor = conn.cursor()
     with open("core/db/create_db.sql", "r") as script:
         cursor.executescript(script.read())
+    cursor.execute("PRAGMA user_version = 0")
+    conn.close()
+    migrate(db_name)
+
+
+def get_migrations(migrations_dir="core/db/migrations"):
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        match = re.match(r"^(\d+)_\w+\.sql$", filename)
+        if match:
+            migrations.append((int(match.group(1)), os.path.join(migrations_dir, filename)))
+    return sorted(migrations)
+
+
+def migrate(db_name=settings.DATABASE, migrations_dir="core/db/migrations"):
+    """Apply migrations newer than the database's user_version, each one in its own transaction."""
+    conn = create_conn(db_name)
+    applied = []
+    try:
+        current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, path in get_migrations(migrations_dir):
+            if version <= current_version:
+                continue
+            with open(path, "r") as script:
+                sql = script.read()
+            try:
+                conn.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {version};\nCOMMIT;")
+            except sqlite3.Error:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+        enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+    if applied:
+        connections.invalidate(db_name)
+        models.Model.clear_schemas(db_name)
+    return applied
+
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """Switch a database created before auto_vacuum was set to incremental, so the maintenance sweep can shrink it."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    # the setting only takes effect on an existing file through a VACUUM, which rewrites it once
+    conn.execute("PRAGMA auto_vacuum = incremental")
+    conn.execute("VACUUM")
+    return True
+
+
+class PooledConnection(sqlite3.Connection):
+    transaction_depth = 0
+
+
+class ConnectionPool(object):
+    """Keeps one long-lived connection per thread and database file."""
+
+    def __init__(self, cached_statements=256):
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.registry = {}
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self, db_name):
+        # connections are only ever used by the thread that opened them, but invalidate()
+        # has to be able to close them from another one. Autocommit mode: reads never open
+        # a transaction, writes are grouped explicitly with Model.transaction().
+        conn = sqlite3.connect(db_name, check_same_thread=False, cached_statements=self.cached_statements,
+                               isolation_level=None, factory=PooledConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, db_name=settings.DATABASE) -> sqlite3.Connection:
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+        generation = self.generations.get(db_name, 0)
+        entry = connections.get(db_name)
+        if entry is not None and entry[0] == generation:
+            with self.lock:
+                self.hits += 1
+            metrics.db_connections_total.inc("hit")
+            return entry[1]
+
+        conn = self.connect(db_name)
+        with self.lock:
+            self.misses += 1
+            self.registry.setdefault(db_name, set()).add(conn)
+        metrics.db_connections_total.inc("miss")
+        connections[db_name] = (generation, conn)
+        return conn
+
+    def release(self):
+        """Close connections opened by the current thread, call it before the thread exits."""
+        connections = getattr(self.local, "connections", {})
+        with self.lock:
+            for db_name, (_, conn) in connections.items():
+                self.registry.get(db_name, set()).discard(conn)
+                conn.close()
+        connections.clear()
+
+    def invalidate(self, db_name=settings.DATABASE):
+        """Close every pooled connection to db_name, threads reconnect on their next get()."""
+        with self.lock:
+            self.generations[db_name] = self.generations.get(db_name, 0) + 1
+            for conn in self.registry.pop(db_name, set()):
+                conn.close()
+
+    def stats(self):
+        with self.lock:
+            opened = sum(len(conns) for conns in self.registry.values())
+            return {"hits": self.hits, "misses": self.misses, "open": opened}
+
+
+connections = ConnectionPool()
 
 
 def get_image_base64(path):
@@ -59,44 +243,114 @@ def get_image_base64(path):
 
 
 class Logger(object):
-    def __init__(self, log_dir="logs", max_log_dir_size=5 * 10 ** 6):
+    """Request threads only enqueue records, a single writer thread appends them to the log in batches."""
+
+    def __init__(self, log_dir="logs", max_log_dir_size=5 * 10 ** 6, backup_count=4, batch_size=512,
+                 max_queue_size=10000, echo=True):
         self.log_dir = log_dir
-        self.log_template = "[%d/%b/%Y %H:%M:%S] {message}"
+        self.log_template = "[%d/%b/%Y %H:%M:%S] "
         self.max_log_dir_size = max_log_dir_size
+        self.backup_count = backup_count
+        # the current file and its backups together stay under max_log_dir_size
+        self.max_file_size = max_log_dir_size // (backup_count + 1)
+        self.batch_size = batch_size
+        # records are also printed to stdout unless echo is off
+        self.echo = echo
         self.filename_prefix = "proton_std"
+        # bounded, a stalled disk must not grow memory without limit: records beyond it are dropped and counted
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.file = None
+        self.file_size = 0
+        self.writer = None
+        self.lock = threading.Lock()
 
-    def get_log_filename(self):
-        if not os.path.exists(self.log_dir):
-            os.mkdir(self.log_dir)
-        all_log_files = sorted(filter(lambda path: self.filename_prefix in path, os.listdir(self.log_dir)))
-        if not all_log_files:
-            filename = f"{self.log_dir}/{self.filename_prefix}.log"
+    def get_log_filename(self, number=0):
+        suffix = f".{number}" if number else ""
+        return f"{self.log_dir}/{self.filename_prefix}.log{suffix}"
+
+    def open(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.file = open(self.get_log_filename(), "ab")
+        self.file_size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for number in range(self.backup_count - 1, 0, -1):
+            filename = self.get_log_filename(number)
+            if os.path.exists(filename):
+                os.replace(filename, self.get_log_filename(number + 1))
+        if self.backup_count > 0:
+            os.replace(self.get_log_filename(), self.get_log_filename(1))
         else:
-            last_file = f"{self.log_dir}/{all_log_files[-1]}"
-            if os.stat(last_file).st_size < self.max_log_dir_size:
-                filename = last_file
-            else:
-                last_file_name_without_ext, _ = last_file.split(".")
+            os.remove(self.get_log_filename())
+        self.open()
+
+    def write_batch(self, logs):
+        if self.file is None:
+            self.open()
+        for log in logs:
+            line = (log + "\n").encode()
+            if self.file_size and self.file_size + len(line) > self.max_file_size:
+                self.file.flush()
+                self.rotate()
+            self.file.write(line)
+            self.file_size += len(line)
+        self.file.flush()
+        if self.echo:
+            print("\n".join(logs))
+
+    def run_writer(self):
+        while True:
+            logs = [self.queue.get()]
+            while len(logs) < self.batch_size:
                 try:
-                    file_number = int(last_file_name_without_ext[-1])
-                except ValueError:
-                    file_number = 1
-                filename = f"{self.log_dir}/{self.filename_prefix}{file_number}.log"
-        return filename
+                    logs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            received = len(logs)
+            dropped = self.take_dropped()
+            if dropped:
+                logs.append(self._get_log_body(f"Logger queue full, dropped {dropped} records"))
+            try:
+                self.write_batch(logs)
+            except OSError as e:
+                print(f"Logger failed: {e}", file=sys.stderr)
+            finally:
+                for _ in range(received):
+                    self.queue.task_done()
+
+    def take_dropped(self):
+        with self.lock:
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        return dropped
+
+    def start_writer(self):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run_writer, name="logger", daemon=True)
+                self.writer.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        self.queue.join()
 
     def _get_log_body(self, message):
         now = datetime.now()
-        log_without_date = self.log_template.format(message=message)
-        full_log = now.strftime(log_without_date)
-        return full_log
+        return now.strftime(self.log_template) + str(message)
 
     def _write(self, message):
         log = self._get_log_body(message)
         log = log.strip("| :")
-        filename = self.get_log_filename()
-        with open(filename, "a") as file:
-            file.write(log + "\n")
-        print(log)
+        if self.writer is None:
+            self.start_writer()
+        try:
+            self.queue.put_nowait(log)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
 
     def error(self, action, message="", host=""):
         if settings.DEBUG:
@@ -114,4 +368,7 @@ class Logger(object):
         self._write(message)
 
     def info(self, message):
-        self._write(message)
\ No newline at end of file
+        self._write(message)
+
+
+logger = Logger()